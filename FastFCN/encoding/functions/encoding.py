@@ -15,24 +15,34 @@ from torch.autograd import Function
 __all__ = ['aggregate', 'scaled_l2']
 
 class Aggregate(Function):
+    # e_k = sum_i a_ik (x_i - d_k) = (A^T X)_k - (sum_i a_ik) d_k: batched
+    # matmuls in both directions, no BxNxKxD residual tensor.
     @staticmethod
     def forward(ctx, A, X, C):
         ctx.save_for_backward(A, X, C)
 
-        return (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) -
-             C.unsqueeze(0).unsqueeze(0)).mul_(A.unsqueeze(3)).sum(1)
+        return torch.bmm(A.transpose(1, 2), X) - A.sum(1).unsqueeze(2) * C.unsqueeze(0)
 
     @staticmethod
     def backward(ctx, GE):
-        A, X, C = ctx.saved_variables
+        A, X, C = ctx.saved_tensors
 
-        gradA = (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) -
-                 C.unsqueeze(0).unsqueeze(0)).mul_(GE.unsqueeze(1)).sum(3)
+        gradA = torch.bmm(X, GE.transpose(1, 2)) - (GE * C.unsqueeze(0)).sum(2).unsqueeze(1)
         gradX = torch.bmm(A, GE)
         gradC = A.sum(1).unsqueeze(2).mul(GE).mul_(-1).sum(0)
 
         return gradA, gradX, gradC
 
+    @staticmethod
+    def symbolic(g, A, X, C):
+        # ONNX export (opset >= 13): the same two matmul terms as forward.
+        AtX = g.op('MatMul', g.op('Transpose', A, perm_i=[0, 2, 1]), X)
+        Asum = g.op('ReduceSum', A, _axes(g, [1]), keepdims_i=1)
+        return g.op('Sub', AtX, g.op('Mul', g.op('Transpose', Asum, perm_i=[0, 2, 1]), C))
+
+def _axes(g, axes):
+    return g.op('Constant', value_t=torch.tensor(axes, dtype=torch.long))
+
 def aggregate(A, X, C):
     r""" Aggregate operation, aggregate the residuals of inputs (:math:`X`) with repect
     to the codewords (:math:`C`) with assignment weights (:math:`A`).
@@ -59,27 +69,36 @@ def aggregate(A, X, C):
     return Aggregate.apply(A, X, C)
 
 class ScaledL2(Function):
+    # s_k ||x_i - c_k||^2 = s_k (||x_i||^2 - 2 x_i.c_k + ||c_k||^2): one
+    # BxNxK matmul instead of a BxNxKxD residual tensor in either direction.
     @staticmethod
     def forward(ctx, X, C, S):
-        SL = (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) -
-              C.unsqueeze(0).unsqueeze(0)).pow_(2).sum(3).mul_(S.view(1, 1, C.size(0)))
-        ctx.save_for_backward(X, C, S, SL)
-        return SL
+        XC = torch.matmul(X, C.t())
+        L2 = X.pow(2).sum(2, keepdim=True) - 2 * XC + C.pow(2).sum(1)
+        ctx.save_for_backward(X, C, S, L2)
+        return L2 * S
 
     @staticmethod
     def backward(ctx, GSL):
-        X, C, S, SL = ctx.saved_variables
+        X, C, S, L2 = ctx.saved_tensors
 
-        tmp = (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) - C.unsqueeze(0).unsqueeze(0)).mul_(
-            (2 * GSL).mul_(S.view(1, 1, C.size(0))).unsqueeze(3)
-        )
-
-        GX = tmp.sum(2)
-        GC = tmp.sum((0, 1)).mul_(-1)
-        GS = SL.div(S.view(1, 1, C.size(0))).mul_(GSL).sum((0, 1))
+        G = GSL * S
+        GX = 2 * (X * G.sum(2, keepdim=True) - torch.matmul(G, C))
+        Gflat = G.reshape(-1, G.size(2))
+        GC = 2 * (C * Gflat.sum(0).unsqueeze(1) - torch.matmul(Gflat.t(), X.reshape(-1, X.size(2))))
+        GS = (GSL * L2).sum((0, 1))
 
         return GX, GC, GS
 
+    @staticmethod
+    def symbolic(g, X, C, S):
+        # ONNX export (opset >= 13): ||x||^2 - 2 x.c + ||c||^2, scaled.
+        XC = g.op('MatMul', X, g.op('Transpose', C, perm_i=[1, 0]))
+        X2 = g.op('ReduceSum', g.op('Mul', X, X), _axes(g, [2]), keepdims_i=1)
+        C2 = g.op('ReduceSum', g.op('Mul', C, C), _axes(g, [1]), keepdims_i=0)
+        L2 = g.op('Add', g.op('Sub', X2, g.op('Add', XC, XC)), C2)
+        return g.op('Mul', L2, S)
+
 def scaled_l2(X, C, S):
     r""" scaled_l2 distance
 
@@ -96,13 +115,14 @@ def scaled_l2(X, C, S):
     return ScaledL2.apply(X, C, S)
 
 if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     B, N, D, K = 3, 4, 5, 6
-    X = torch.randn((B, N, D), dtype=torch.double,requires_grad=True).cuda()
-    C = torch.randn((K, D), dtype=torch.double,requires_grad=True).cuda()
-    S = torch.randn((K,), dtype=torch.double,requires_grad=True).cuda()
+    X = torch.randn((B, N, D), dtype=torch.double, device=device, requires_grad=True)
+    C = torch.randn((K, D), dtype=torch.double, device=device, requires_grad=True)
+    S = torch.randn((K,), dtype=torch.double, device=device, requires_grad=True)
     assert torch.autograd.gradcheck(scaled_l2, (X, C, S))
 
-    A = torch.randn((B, N, K), dtype=torch.double, requires_grad=True).cuda()
-    X = torch.randn((B, N, D), dtype=torch.double, requires_grad=True).cuda()
-    C = torch.randn((K, D), dtype=torch.double, requires_grad=True).cuda()
+    A = torch.randn((B, N, K), dtype=torch.double, device=device, requires_grad=True)
+    X = torch.randn((B, N, D), dtype=torch.double, device=device, requires_grad=True)
+    C = torch.randn((K, D), dtype=torch.double, device=device, requires_grad=True)
     assert torch.autograd.gradcheck(aggregate, (A, X, C))
@@ -98,10 +98,14 @@ class Encoding(Module):
             X = X.view(B, D, -1).transpose(1, 2).contiguous()
         else:
             raise RuntimeError('Encoding Layer unknown input dims!')
-        # assignment weights BxNxK
-        A = F.softmax(scaled_l2(X, self.codewords, self.scale), dim=2)
-        # aggregate
-        E = aggregate(A, X, self.codewords)
+        # soft assignment and residual sums stay in fp32 under autocast
+        if X.dtype in (torch.float16, torch.bfloat16):
+            X = X.float()
+        with torch.autocast(X.device.type, enabled=False):
+            # assignment weights BxNxK
+            A = F.softmax(scaled_l2(X, self.codewords, self.scale), dim=2)
+            # aggregate
+            E = aggregate(A, X, self.codewords)
         return E
 
     def __repr__(self):
@@ -11,6 +11,7 @@
 """Synchronized Cross-GPU Batch Normalization Module"""
 import collections
 import torch
+import torch.distributed as dist
 
 from torch.nn.modules.batchnorm import _BatchNorm
 from torch.nn.functional import batch_norm
@@ -37,6 +38,15 @@ class SyncBatchNorm(_BatchNorm):
                 input, self.running_mean, self.running_var, self.weight, self.bias,
                 self.training, self.momentum, self.eps)
 
+        if self._parallel_id is None:
+            # Not replicated by DataParallel: sync through the process group
+            # under torch.distributed, otherwise plain batch norm.
+            if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+                return self._process_group_forward(input)
+            return batch_norm(
+                input, self.running_mean, self.running_var, self.weight, self.bias,
+                True, self.momentum, self.eps)
+
         # Resize the input to (B, C, -1).
         input_shape = input.size()
         input = input.view(input_shape[0], self.num_features, -1)
@@ -54,6 +64,35 @@ class SyncBatchNorm(_BatchNorm):
         # forward
         return normalization(input, mean, inv_std, self.weight, self.bias).view(input_shape)
 
+    def _process_group_forward(self, input):
+        """Batch statistics over every rank of the default process group. The
+        all-reduces are differentiable, so gradients w.r.t. the global mean and
+        variance are summed across ranks in backward. Works with gloo on CPU."""
+        from torch.distributed.nn.functional import all_reduce
+
+        input_shape = input.size()
+        x = input.view(input_shape[0], self.num_features, -1).float()
+
+        # Global mean first, then the centered sum of squares (more stable
+        # than E[x^2] - E[x]^2).
+        count = x.new_full((1,), x.size(0) * x.size(2))
+        sums = all_reduce(torch.cat([x.sum((0, 2)), count]))
+        size = sums[-1]
+        mean = sums[:-1] / size
+        centered = x - mean.view(1, -1, 1)
+        var = all_reduce(centered.pow(2).sum((0, 2))) / size
+
+        with torch.no_grad():
+            unbias_var = var * size / (size - 1).clamp(min=1)
+            self.running_mean.mul_(1 - self.momentum).add_(self.momentum * mean)
+            self.running_var.mul_(1 - self.momentum).add_(self.momentum * unbias_var)
+            self.num_batches_tracked += 1
+
+        out = centered * torch.rsqrt(var + self.eps).view(1, -1, 1)
+        if self.affine:
+            out = out * self.weight.view(1, -1, 1) + self.bias.view(1, -1, 1)
+        return out.to(input.dtype).view(input_shape)
+
     def __data_parallel_replicate__(self, ctx, copy_id):
         self._parallel_id = copy_id
 
@@ -32,10 +32,26 @@ def lovasz_grad(gt_sorted):
     return jaccard
 
 
+def lovasz_grad_batched(gt_sorted, valid_sorted=None):
+    """
+    lovasz_grad for a batch of sorted ground truths [B, P], in one pass.
+    Pixels with valid_sorted == 0 add to neither intersection nor union.
+    """
+    gt_sorted = gt_sorted.float()
+    gts = gt_sorted.sum(1, keepdim=True)
+    intersection = gts - gt_sorted.cumsum(1)
+    negatives = 1. - gt_sorted if valid_sorted is None else valid_sorted.float() - gt_sorted
+    # union >= 1 for every valid prefix; the clamp only guards all-ignored images
+    union = (gts + negatives.cumsum(1)).clamp(min=1.)
+    jaccard = 1. - intersection / union
+    return torch.cat([jaccard[:, :1], jaccard[:, 1:] - jaccard[:, :-1]], 1)
+
+
 def iou_binary(preds, labels, incl_bg=True, EMPTY=1., ignore=None, per_image=True):
     """
     IoU for foreground class
     binary: 1 foreground, 0 background
+    ignore: label of pixels left out of both intersection and union (nodata)
     """
     if not per_image:
         preds, labels = (preds,), (labels,)
@@ -48,7 +64,8 @@ def iou_binary(preds, labels, incl_bg=True, EMPTY=1., ignore=None, per_image=Tru
             intersection = ((label == 1) & (pred == 1)).sum()
     
         if incl_bg:
-            union = 1024**2
+            # Fraction of scored pixels labeled correctly.
+            union = label.numel() if ignore is None else (label != ignore).sum()
         else:
             union = ((label == 1) | ((pred == 1) & (label != ignore))).sum()
 
@@ -87,15 +104,24 @@ def iou(preds, labels, C, EMPTY=1., ignore=None, per_image=False):
 # --------------------------- BINARY LOSSES ---------------------------
 
 
-def lovasz_hinge(logits, labels, per_image=True, ignore=None):
+def lovasz_hinge(logits, labels, per_image=True, ignore=None, batched=True, bins=None):
     """
     Binary Lovasz hinge loss
       logits: [B, H, W] Variable, logits at each pixel (between -\infty and +\infty)
       labels: [B, H, W] Tensor, binary ground truth masks (0 or 1)
       per_image: compute the loss per image instead of per batch
       ignore: void class id
+      batched: per image, sort the whole batch at once (lovasz_hinge_batched)
+               instead of looping over images
+      bins: if set, use the O(P) histogram approximation (lovasz_hinge_hist)
     """
-    if per_image:
+    if bins:
+        if not per_image:
+            logits, labels = logits.reshape(1, -1), labels.reshape(1, -1)
+        loss = lovasz_hinge_hist(logits, labels, bins, ignore)
+    elif per_image and batched:
+        loss = lovasz_hinge_batched(logits, labels, ignore)
+    elif per_image:
         loss = mean(lovasz_hinge_flat(*flatten_binary_scores(log.unsqueeze(0), lab.unsqueeze(0), ignore))
                           for log, lab in zip(logits, labels))
     else:
@@ -123,6 +149,80 @@ def lovasz_hinge_flat(logits, labels):
     return loss
 
 
+def lovasz_hinge_batched(logits, labels, ignore=None):
+    """
+    Per-image binary Lovasz hinge, averaged over the batch, without a Python loop
+      logits: [B, ...] Variable, logits at each pixel
+      labels: [B, ...] Tensor, binary ground truth masks (0 or 1)
+      ignore: void class id
+    Ignored pixels get an error of -inf, so they sort last in their row and
+    add nothing to the loss or to the Jaccard counts.
+    """
+    logits = logits.reshape(logits.size(0), -1)
+    labels = labels.reshape(labels.size(0), -1)
+    gt = labels.float()
+    valid = None
+    signs = 2. * gt - 1.
+    errors = 1. - logits * signs
+    if ignore is not None:
+        valid = labels != ignore
+        gt = gt * valid
+        errors = errors.masked_fill(~valid, float('-inf'))
+    errors_sorted, perm = torch.sort(errors, dim=1, descending=True)
+    gt_sorted = gt.gather(1, perm)
+    valid_sorted = None if valid is None else valid.gather(1, perm)
+    grad = lovasz_grad_batched(gt_sorted, valid_sorted)
+    loss = (F.relu(errors_sorted) * grad).sum(1)
+    return loss.mean()
+
+
+def lovasz_hinge_hist(logits, labels, bins=256, ignore=None):
+    """
+    Approximate per-image binary Lovasz hinge in O(P), without sorting
+      logits: [B, ...] Variable, logits at each pixel
+      labels: [B, ...] Tensor, binary ground truth masks (0 or 1)
+      bins: number of equal-width error bins per image, over (0, max error]
+      ignore: void class id
+    Positive errors are bucketed into bins. Cumulative positive / negative
+    counts from the top bin down give the Jaccard loss of every bin prefix,
+    and each bin's Jaccard increment is shared equally by its pixels in
+    place of lovasz_grad. Ties only occur within a bin and the increments
+    are non-negative and sum to at most 1, so each image's loss is within
+    one bin width (max error / bins) of lovasz_hinge_flat.
+    """
+    batch = logits.size(0)
+    logits = logits.reshape(batch, -1)
+    labels = labels.reshape(batch, -1)
+    gt = labels.float()
+    errors = 1. - logits * (2. * gt - 1.)
+    scored = errors.detach() > 0
+    if ignore is not None:
+        valid = labels != ignore
+        gt = gt * valid
+        scored = scored & valid
+    gts = gt.sum(1, keepdim=True)
+
+    with torch.no_grad():
+        e = errors.detach()
+        width = (e.masked_fill(~scored, 0).max(1, keepdim=True)[0] / bins).clamp(min=1e-12)
+        bin_idx = (e / width).long().clamp(0, bins - 1)
+        flat_idx = (bin_idx + bins * torch.arange(batch, device=e.device).unsqueeze(1))[scored]
+        pos = torch.zeros(batch * bins, device=e.device).index_add_(0, flat_idx, gt[scored])
+        tot = torch.zeros(batch * bins, device=e.device).index_add_(0, flat_idx, torch.ones_like(flat_idx, dtype=pos.dtype))
+        pos, tot = pos.view(batch, bins), tot.view(batch, bins)
+        # Pixels in bin k or above, i.e. with error >= k * width.
+        cum_pos = pos.flip(1).cumsum(1).flip(1)
+        cum_neg = (tot - pos).flip(1).cumsum(1).flip(1)
+        jaccard = 1. - (gts - cum_pos) / (gts + cum_neg).clamp(min=1.)
+        jaccard = jaccard * (tot.flip(1).cumsum(1).flip(1) > 0)
+        increment = jaccard - torch.cat([jaccard[:, 1:], jaccard.new_zeros(batch, 1)], 1)
+        bin_grad = increment / tot.clamp(min=1.)
+        weights = bin_grad.gather(1, bin_idx) * scored
+
+    loss = (F.relu(errors) * weights).sum(1)
+    return loss.mean()
+
+
 def flatten_binary_scores(scores, labels, ignore=None):
     """
     Flattens predictions in the batch (binary case)
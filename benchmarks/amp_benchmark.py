@@ -0,0 +1,126 @@
+'''
+# ------------------------------------------
+# Benchmark: autocast precision for training and inference
+# ------------------------------------------
+
+For fp32 and each autocast precision, times a training step of a trained
+model (Lovasz hinge on outputs cast back to fp32), records peak memory and
+scores validation tiles with iou_binary, so bf16 / fp16 can be compared
+with fp32 for throughput, memory and IoU.
+
+Peak memory is torch.cuda.max_memory_allocated on CUDA. On CPU each
+precision runs in a fresh process and the growth of its max RSS is reported.
+
+Run from the repository root:
+    python -m benchmarks.amp_benchmark -model_name my_model -precisions fp32 bf16 -device cpu
+'''
+
+import argparse
+import itertools
+import resource
+import time
+
+import torch
+
+import LovaszSoftmax.pytorch.lovasz_losses as L
+from benchmarks.common import measure
+from evaluate import load_model_with_weights
+from pipeline.amp import amp_dtype, autocast, grad_scaler, to_float
+from pipeline.load import get_dataloader, IGNORE_LABEL
+
+
+def _run(precision, model_name, in_dir, batch_size, crop, repeats, val_batches, device):
+    device = torch.device(device)
+    cuda = device.type == 'cuda'
+    dtype = None if precision == 'fp32' else amp_dtype(precision, device)
+    model = load_model_with_weights(model_name=model_name).to(device)
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=1e-4, momentum=0.9)
+    scaler = grad_scaler(dtype)
+
+    images = torch.rand(batch_size, 3, crop, crop, device=device)
+    masks = (torch.rand(batch_size, crop, crop, device=device) > 0.7).long()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    def step():
+        optimizer.zero_grad()
+        with autocast(device, dtype):
+            outputs = model(images)
+        loss = L.lovasz_hinge(to_float(outputs)[0], masks, ignore=IGNORE_LABEL)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    model.train()
+    step()  # warm-up
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    if cuda:
+        peak = torch.cuda.max_memory_allocated() / 1024**2
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024
+
+    # Validation IoU with the trained weights (the steps above used lr 1e-4).
+    model = load_model_with_weights(model_name=model_name).to(device).eval()
+    loader = get_dataloader(in_dir=in_dir, batch_size=batch_size, split='test')
+    ious = []
+    with torch.no_grad():
+        for images, masks, _ in itertools.islice(loader, val_batches):
+            with autocast(device, dtype):
+                outputs = model(images.to(device))
+            preds = (to_float(outputs)[0] > 0).long()
+            ious.append(L.iou_binary(preds, masks.to(device), ignore=IGNORE_LABEL))
+    return batch_size / elapsed, peak, sum(ious) / max(len(ious), 1)
+
+
+def run(model_name, in_dir, precisions, batch_size, crop, repeats, val_batches, device):
+    print('B={} crop={} on {}'.format(batch_size, crop, device))
+    print('{:<6} {:>12} {:>10} {:>10}'.format('prec', 'train t/s', 'peak MB', 'val IoU'))
+    for precision in precisions:
+        tiles_s, peak, iou = measure(
+            _run, (precision, model_name, in_dir, batch_size, crop, repeats, val_batches, device), device)
+        print('{:<6} {:>12.2f} {:>10.1f} {:>10.4f}'.format(precision, tiles_s, peak, iou))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-model_name', type=str, required=True,
+        help='Name of a trained model in the models/ directory.')
+    PARSER.add_argument(
+        '-in_dir', default='training_data', type=str, required=False,
+        help='Data directory.')
+    PARSER.add_argument(
+        '-precisions', default=['fp32', 'bf16'], nargs='+', required=False,
+        choices=['fp32', 'bf16', 'fp16'],
+        help='Precisions to compare.')
+    PARSER.add_argument(
+        '-batch_size', default=4, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-crop', default=460, type=int, required=False,
+        help='Training crop size in pixels.')
+    PARSER.add_argument(
+        '-repeats', default=5, type=int, required=False,
+        help='Timed training steps per precision.')
+    PARSER.add_argument(
+        '-val_batches', default=16, type=int, required=False,
+        help='Validation batches scored per precision.')
+    PARSER.add_argument(
+        '-device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.model_name, ARGS.in_dir, ARGS.precisions, ARGS.batch_size, ARGS.crop, ARGS.repeats,
+        ARGS.val_batches, ARGS.device)
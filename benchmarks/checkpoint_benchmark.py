@@ -0,0 +1,151 @@
+'''
+# ------------------------------------------
+# Benchmark: activation checkpointing granularity
+# ------------------------------------------
+
+Times a training step of EncNet (dilated ResNet50 + JPU, Lovasz hinge) and
+records its peak memory for each activation checkpointing configuration and
+batch size, with the whole backbone unfrozen as in the last layer_gen
+epochs. Pick the largest batch whose peak fits, at an acceptable step time.
+
+Before timing, each configuration is checked against a plain training
+step: gradients and BatchNorm running statistics must match.
+
+Peak memory is torch.cuda.max_memory_allocated on CUDA. On CPU each run
+happens in a fresh process and the growth of its max RSS is reported.
+
+Run from the repository root:
+    python -m benchmarks.checkpoint_benchmark -batch_sizes 4 8 16 -crop 460
+'''
+
+import argparse
+import resource
+import time
+
+import torch
+from torch import nn
+
+import LovaszSoftmax.pytorch.lovasz_losses as L
+from benchmarks.common import measure
+import pipeline.network as Network
+
+# name: (checkpointed segments, per-block)
+CONFIGS = {
+    'none': ([], False),
+    'layer34': (['layer3', 'layer4'], False),
+    'block34': (['layer3', 'layer4'], True),
+    'layer34+jpu': (['layer3', 'layer4', 'jpu'], False),
+    'block34+jpu': (['layer3', 'layer4', 'jpu'], True),
+    'block_all+jpu': (Network.CHECKPOINT_SEGMENTS, True),
+    }
+
+
+def make_model(config, device):
+    segments, blocks = CONFIGS[config]
+    model = Network.EncNet(1, backbone='resnet50', root='FastFCN/encoding/models', dilated=True,
+                           lateral=False, jpu=True, aux=False, se_loss=False, norm_layer=nn.BatchNorm2d,
+                           checkpoint_segments=segments, checkpoint_blocks=blocks)
+    model.requires_grad_()
+    return model.to(device).train()
+
+
+def check(config, device, crop=128):
+    '''
+    One training step with config must give the gradients and BatchNorm
+    running statistics of the same step without checkpointing (BN buffers
+    updated once, not again during recomputation).
+    '''
+    images = torch.rand(2, 3, crop, crop, device=device)
+    masks = (torch.rand(2, crop, crop, device=device) > 0.7).long()
+    ref = make_model('none', device)
+    model = make_model(config, device)
+    model.load_state_dict(ref.state_dict())
+    for m in [ref, model]:
+        torch.manual_seed(0)  # same dropout masks
+        L.lovasz_hinge(m(images)[0], masks).backward()
+    for (name, a), b in zip(ref.named_buffers(), model.buffers()):
+        assert torch.allclose(a.float(), b.float(), rtol=1e-4, atol=1e-6), name
+    for (name, a), b in zip(ref.named_parameters(), model.parameters()):
+        assert torch.allclose(a.grad, b.grad, rtol=1e-3, atol=1e-5), name
+
+
+def _run(config, batch_size, crop, repeats, device):
+    device = torch.device(device)
+    cuda = device.type == 'cuda'
+    model = make_model(config, device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4, momentum=0.9)
+    images = torch.rand(batch_size, 3, crop, crop, device=device)
+    masks = (torch.rand(batch_size, crop, crop, device=device) > 0.7).long()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    def step():
+        optimizer.zero_grad()
+        loss = L.lovasz_hinge(model(images)[0], masks)
+        loss.backward()
+        optimizer.step()
+
+    step()  # warm-up
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    if cuda:
+        peak = torch.cuda.max_memory_allocated() / 1024**2
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024
+    return elapsed, peak
+
+
+def measure_or_oom(config, batch_size, crop, repeats, device):
+    try:
+        return measure(_run, (config, batch_size, crop, repeats, device), device)
+    except RuntimeError as err:
+        if 'out of memory' not in str(err):
+            raise
+        torch.cuda.empty_cache()
+        return None
+
+
+def run(configs, batch_sizes, crop, repeats, device):
+    print('crop={} on {}, backbone unfrozen'.format(crop, device))
+    print('{:<14} {:>6} {:>10} {:>10}'.format('config', 'batch', 'ms/step', 'peak MB'))
+    for config in configs:
+        check(config, torch.device(device))
+        for batch_size in batch_sizes:
+            result = measure_or_oom(config, batch_size, crop, repeats, device)
+            if result is None:
+                print('{:<14} {:>6} {:>10} {:>10}'.format(config, batch_size, 'OOM', '-'))
+                break
+            elapsed, peak = result
+            print('{:<14} {:>6} {:>10.1f} {:>10.1f}'.format(config, batch_size, 1000 * elapsed, peak))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-configs', default=list(CONFIGS), nargs='+', required=False, choices=list(CONFIGS),
+        help='Checkpointing configurations to compare.')
+    PARSER.add_argument(
+        '-batch_sizes', default=[4, 8, 16], type=int, nargs='+', required=False,
+        help='Batch sizes to time, smallest first.')
+    PARSER.add_argument(
+        '-crop', default=460, type=int, required=False,
+        help='Crop size in pixels.')
+    PARSER.add_argument(
+        '-repeats', default=3, type=int, required=False,
+        help='Timed steps per configuration.')
+    PARSER.add_argument(
+        '-device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.configs, ARGS.batch_sizes, ARGS.crop, ARGS.repeats, ARGS.device)
@@ -0,0 +1,21 @@
+'''
+# ------------------------------------------
+# Benchmark helpers
+# ------------------------------------------
+'''
+
+import multiprocessing as mp
+
+
+def measure(run, args, device):
+    '''
+    run(*args), in a fresh spawned process on CPU so that its max RSS
+    reflects only this run; in this process on CUDA, where peak memory
+    stats can be reset instead.
+
+    run must be a module-level function so the spawned process can import it.
+    '''
+    if device == 'cpu':
+        with mp.get_context('spawn').Pool(1) as pool:
+            return pool.apply(run, args)
+    return run(*args)
@@ -0,0 +1,206 @@
+'''
+# ------------------------------------------
+# Benchmark: Encoding layer functions
+# ------------------------------------------
+
+Compares the matmul formulations of scaled_l2 and aggregate in
+FastFCN/encoding/functions/encoding.py with the original implementations,
+which materialized a BxNxKxD residual tensor in forward and backward.
+Gradients are checked against the originals (gradcheck on small doubles,
+plus a direct comparison at full size), then forward + backward time and
+peak memory are reported at EncModule's shapes (D=512, K=32) on 60x60
+feature maps, for each function alone and for a training step of EncNet's
+head (EncHead on JPU features), which runs both.
+
+Peak memory is torch.cuda.max_memory_allocated on CUDA. On CPU each run
+happens in a fresh process and the growth of its max RSS is reported.
+
+Run from the repository root:
+    python -m benchmarks.encoding_benchmark -batch_size 8 -size 60 -device cpu
+'''
+
+import argparse
+import resource
+import time
+
+import torch
+from torch import nn
+from torch.autograd import Function
+
+import FastFCN.encoding.nn.encoding as encoding_nn
+from FastFCN.encoding.functions import aggregate, scaled_l2
+from benchmarks.common import measure
+from pipeline.network import EncHead, UP_KWARGS
+
+
+# ---- Original implementations (reference) ----
+
+class ReferenceAggregate(Function):
+    @staticmethod
+    def forward(ctx, A, X, C):
+        ctx.save_for_backward(A, X, C)
+
+        return (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) -
+             C.unsqueeze(0).unsqueeze(0)).mul_(A.unsqueeze(3)).sum(1)
+
+    @staticmethod
+    def backward(ctx, GE):
+        A, X, C = ctx.saved_tensors
+
+        gradA = (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) -
+                 C.unsqueeze(0).unsqueeze(0)).mul_(GE.unsqueeze(1)).sum(3)
+        gradX = torch.bmm(A, GE)
+        gradC = A.sum(1).unsqueeze(2).mul(GE).mul_(-1).sum(0)
+
+        return gradA, gradX, gradC
+
+
+class ReferenceScaledL2(Function):
+    @staticmethod
+    def forward(ctx, X, C, S):
+        SL = (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) -
+              C.unsqueeze(0).unsqueeze(0)).pow_(2).sum(3).mul_(S.view(1, 1, C.size(0)))
+        ctx.save_for_backward(X, C, S, SL)
+        return SL
+
+    @staticmethod
+    def backward(ctx, GSL):
+        X, C, S, SL = ctx.saved_tensors
+
+        tmp = (X.unsqueeze(2).expand(X.size(0), X.size(1), C.size(0), C.size(1)) - C.unsqueeze(0).unsqueeze(0)).mul_(
+            (2 * GSL).mul_(S.view(1, 1, C.size(0))).unsqueeze(3)
+        )
+
+        GX = tmp.sum(2)
+        GC = tmp.sum((0, 1)).mul_(-1)
+        GS = SL.div(S.view(1, 1, C.size(0))).mul_(GSL).sum((0, 1))
+
+        return GX, GC, GS
+
+
+FUNCTIONS = {
+    'scaled_l2': {'matmul': scaled_l2, 'reference': ReferenceScaledL2.apply},
+    'aggregate': {'matmul': aggregate, 'reference': ReferenceAggregate.apply},
+    }
+
+
+class HeadStep(object):
+    '''
+    EncHead forward + backward on JPU-sized features, using one implementation
+    of both Encoding functions.
+    '''
+    def __init__(self, impl):
+        self.impl = impl
+
+    def __call__(self, head, feat):
+        encoding_nn.scaled_l2 = FUNCTIONS['scaled_l2'][self.impl]
+        encoding_nn.aggregate = FUNCTIONS['aggregate'][self.impl]
+        try:
+            return head(None, None, None, feat)[0]
+        finally:
+            encoding_nn.scaled_l2, encoding_nn.aggregate = scaled_l2, aggregate
+
+
+def make_inputs(name, B, N, D, K, device, dtype=torch.float):
+    def rand(*shape):
+        return (torch.rand(*shape, dtype=dtype, device=device) - 0.5).requires_grad_()
+    if name == 'scaled_l2':
+        return rand(B, N, D), rand(K, D), rand(K)
+    if name == 'aggregate':
+        return rand(B, N, K), rand(B, N, D), rand(K, D)
+    # head: EncHead on the JPU output (4 x 512 channels), N = size * size
+    size = int(round(N ** 0.5))
+    head = EncHead([512, 1024, 2048], 1, se_loss=False, jpu=True,
+                   norm_layer=nn.BatchNorm2d, up_kwargs=UP_KWARGS).to(device=device, dtype=dtype)
+    return head, rand(B, 2048, size, size)
+
+
+def check(name, device):
+    fns = FUNCTIONS[name]
+    inputs = make_inputs(name, 2, 7, 5, 3, device, dtype=torch.double)
+    assert torch.autograd.gradcheck(fns['matmul'], inputs)
+
+    inputs = make_inputs(name, 2, 900, 512, 32, device)
+    grads = []
+    for impl in ['reference', 'matmul']:
+        for t in inputs:
+            t.grad = None
+        out = fns[impl](*inputs)
+        out.backward(torch.ones_like(out))
+        grads.append([out.detach()] + [t.grad.clone() for t in inputs])
+    for ref, new in zip(*grads):
+        assert torch.allclose(ref, new, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+    print('{}: gradcheck passed, outputs and gradients match the reference.'.format(name))
+
+
+def _run(name, impl, B, N, D, K, device, repeats):
+    device = torch.device(device)
+    cuda = device.type == 'cuda'
+    fn = HeadStep(impl) if name == 'head' else FUNCTIONS[name][impl]
+    inputs = make_inputs(name, B, N, D, K, device)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_cuda = torch.cuda.memory_allocated()
+
+    out = fn(*inputs)
+    out.backward(torch.ones_like(out))  # warm-up
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn(*inputs)
+        out.backward(torch.ones_like(out))
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+
+    if cuda:
+        peak = (torch.cuda.max_memory_allocated() - base_cuda) / 1024**2
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024
+    return elapsed, peak
+
+
+def run(names, batch_size, size, D, K, repeats, device):
+    N = size * size
+    print('B={} N={}x{} D={} K={} on {}'.format(batch_size, size, size, D, K, device))
+    print('{:<10} {:<10} {:>10} {:>12}'.format('function', 'impl', 'ms/step', 'peak MB'))
+    for name in names:
+        if name != 'head':
+            check(name, torch.device(device))
+        for impl in ['reference', 'matmul']:
+            elapsed, peak = measure(_run, (name, impl, batch_size, N, D, K, device, repeats), device)
+            print('{:<10} {:<10} {:>10.1f} {:>12.1f}'.format(name, impl, 1000 * elapsed, peak))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-functions', default=list(FUNCTIONS) + ['head'], nargs='+', required=False,
+        choices=list(FUNCTIONS) + ['head'],
+        help='Functions to benchmark (head: an EncHead training step).')
+    PARSER.add_argument(
+        '-batch_size', default=8, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-size', default=60, type=int, required=False,
+        help='Feature map height and width.')
+    PARSER.add_argument(
+        '-D', default=512, type=int, required=False,
+        help='Feature channels.')
+    PARSER.add_argument(
+        '-K', default=32, type=int, required=False,
+        help='Codewords.')
+    PARSER.add_argument(
+        '-repeats', default=5, type=int, required=False,
+        help='Timed steps per implementation.')
+    PARSER.add_argument(
+        '-device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.functions, ARGS.batch_size, ARGS.size, ARGS.D, ARGS.K, ARGS.repeats, ARGS.device)
@@ -0,0 +1,88 @@
+'''
+# ------------------------------------------
+# Benchmark: head-only training from cached backbone features
+# ------------------------------------------
+
+Times a training step of the JPU and EncHead with the backbone frozen, once
+running the backbone on image crops and once starting from fp16 c2..c4
+features (as read from the feature cache), and reports the speedup and the
+cache size per tile.
+
+Run from the repository root:
+    python -m benchmarks.feature_cache_benchmark -batch_size 16 -crop 460
+'''
+
+import argparse
+import time
+
+import torch
+from torch import nn
+
+import LovaszSoftmax.pytorch.lovasz_losses as L
+import pipeline.network as Network
+
+
+def time_steps(step, repeats, cuda):
+    step()  # warm-up
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def run(batch_size, crop, repeats, device):
+    device = torch.device(device)
+    cuda = device.type == 'cuda'
+    model = Network.EncNet(1, backbone='resnet50', root='FastFCN/encoding/models', dilated=True,
+                           lateral=False, jpu=True, aux=False, se_loss=False,
+                           norm_layer=nn.BatchNorm2d).to(device).train()
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=1e-4, momentum=0.9)
+    images = torch.rand(batch_size, 3, crop, crop, device=device)
+    masks = (torch.rand(batch_size, crop, crop, device=device) > 0.7).long()
+    with torch.no_grad():
+        features = [f.half() for f in model.eval().backbone_forward(images)[1:]]
+    model.train()
+
+    def image_step():
+        optimizer.zero_grad()
+        L.lovasz_hinge(model(images)[0], masks).backward()
+        optimizer.step()
+
+    def cached_step():
+        optimizer.zero_grad()
+        c2, c3, c4 = (f.float() for f in features)
+        outputs = model.head_forward(model.jpu_forward(None, c2, c3, c4), masks.shape[-2:])
+        L.lovasz_hinge(outputs[0], masks).backward()
+        optimizer.step()
+
+    t_image = time_steps(image_step, repeats, cuda)
+    t_cached = time_steps(cached_step, repeats, cuda)
+    tile_mb = sum(f[0].numel() * 2 for f in features) / 1024**2
+    print('B={} crop={} on {}'.format(batch_size, crop, device))
+    print('images: {:.1f} ms/step, cached: {:.1f} ms/step, speedup {:.1f}x, {:.1f} MB cached per tile'.format(
+        1000 * t_image, 1000 * t_cached, t_image / t_cached, tile_mb))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-batch_size', default=16, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-crop', default=460, type=int, required=False,
+        help='Crop size in pixels.')
+    PARSER.add_argument(
+        '-repeats', default=5, type=int, required=False,
+        help='Timed steps per mode.')
+    PARSER.add_argument(
+        '-device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.batch_size, ARGS.crop, ARGS.repeats, ARGS.device)
@@ -0,0 +1,78 @@
+'''
+# ------------------------------------------
+# Benchmark: BatchNorm folding for inference
+# ------------------------------------------
+
+Loads a trained model and times eval-mode inference on full tiles for the
+original network, the network with BatchNorm folded into its convolutions,
+and the folded network traced, frozen and optimized for inference (conv +
+ReLU fusion). The outputs of each variant are checked against the original.
+
+Run from the repository root:
+    python -m benchmarks.fuse_benchmark -model_name my_model -size 1024 -device cpu
+'''
+
+import argparse
+import time
+
+import torch
+
+from evaluate import load_model_with_weights
+from pipeline.fuse import prepare_inference
+
+
+def time_model(model, example, repeats, device):
+    cuda = device.type == 'cuda'
+    with torch.no_grad():
+        model(example)  # warm-up
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(example)
+        if cuda:
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def run(model_name, batch_size, size, repeats, device):
+    device = torch.device(device)
+    model = load_model_with_weights(model_name=model_name).to(device).eval()
+    example = torch.rand(batch_size, 3, size, size, device=device)
+
+    variants = [
+        ('original', model),
+        ('folded', prepare_inference(model, example, jit=False)),
+        ('folded+jit', prepare_inference(model, example, jit=True)),
+        ]
+    print('B={} tile={}x{} on {}'.format(batch_size, size, size, device))
+    print('{:<12} {:>10} {:>8}'.format('variant', 'ms/batch', 'speedup'))
+    base = None
+    for name, variant in variants:
+        elapsed = time_model(variant, example, repeats, device)
+        base = base or elapsed
+        print('{:<12} {:>10.1f} {:>8.2f}'.format(name, 1000 * elapsed, base / elapsed))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-model_name', type=str, required=True,
+        help='Name of a trained model in the models/ directory.')
+    PARSER.add_argument(
+        '-batch_size', default=1, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-size', default=1024, type=int, required=False,
+        help='Tile height and width.')
+    PARSER.add_argument(
+        '-repeats', default=5, type=int, required=False,
+        help='Timed batches per variant.')
+    PARSER.add_argument(
+        '-device', default='cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.model_name, ARGS.batch_size, ARGS.size, ARGS.repeats, ARGS.device)
@@ -0,0 +1,102 @@
+'''
+# ------------------------------------------
+# Benchmark: cold-cache epoch time by access order
+# ------------------------------------------
+
+Times one pass over the training tiles with the current global shuffle and
+with SceneBlockSampler, starting each from a cold page cache. Pages of the
+image and mask files are dropped with posix_fadvise(DONTNEED) before each
+run, which needs no root but only evicts clean pages; run on an idle
+machine, or additionally `echo 1 > /proc/sys/vm/drop_caches` as root.
+
+Also reports how mixed the batches are (distinct scenes per batch).
+
+Run from the repository root:
+    python -m benchmarks.locality_benchmark -in_dir training_data -workers 4
+'''
+
+import argparse
+import os
+import time
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from pipeline.load import MyDataset, train_transform
+from pipeline.sampler import SceneBlockSampler
+
+
+def drop_page_cache(paths):
+    '''
+    Ask the kernel to evict cached pages of every file in paths.
+    '''
+    if not hasattr(os, 'posix_fadvise'):
+        print('posix_fadvise is not available; results are not cold-cache.')
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def time_epoch(dataset, loader, max_batches):
+    drop_page_cache(dataset.images + dataset.masks)
+    scenes = np.asarray(dataset.scenes)
+    index = {path: i for i, path in enumerate(dataset.images)}
+    mixing = []
+    n = 0
+    start = time.perf_counter()
+    for i, (images, _, names) in enumerate(loader):
+        n += images.size(0)
+        mixing.append(len(set(scenes[[index[name] for name in names]])))
+        if max_batches and i + 1 >= max_batches:
+            break
+    return n / (time.perf_counter() - start), float(np.mean(mixing))
+
+
+def run(in_dir, batch_size, num_workers, max_batches, block_size, buffer_blocks):
+    dataset = MyDataset(in_dir=in_dir, custom_transforms=train_transform, split='train')
+    loaders = [
+        ('random shuffle', DataLoader(
+            dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers)),
+        ('scene blocks', DataLoader(
+            dataset, batch_size=batch_size, num_workers=num_workers,
+            sampler=SceneBlockSampler(
+                dataset.scenes, block_size=block_size, buffer_blocks=buffer_blocks,
+                batch_size=batch_size, num_workers=num_workers, seed=0))),
+        ]
+
+    print('{:<16} {:>10} {:>16}'.format('order', 'img/s', 'scenes/batch'))
+    for name, loader in loaders:
+        rate, mixing = time_epoch(dataset, loader, max_batches)
+        print('{:<16} {:>10.1f} {:>16.2f}'.format(name, rate, mixing))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-in_dir', default='training_data', type=str, required=False,
+        help='Folder containing training images, with images and masks subdirectory.')
+    PARSER.add_argument(
+        '-batch_size', default=16, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-workers', default=4, type=int, required=False,
+        help='Loader workers.')
+    PARSER.add_argument(
+        '-batches', default=0, type=int, required=False,
+        help='Batches timed per order (0 for a full epoch).')
+    PARSER.add_argument(
+        '-block_size', default=64, type=int, required=False,
+        help='Tiles per scene block.')
+    PARSER.add_argument(
+        '-buffer_blocks', default=4, type=int, required=False,
+        help='Blocks shuffled together per worker.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.in_dir, ARGS.batch_size, ARGS.workers, ARGS.batches, ARGS.block_size, ARGS.buffer_blocks)
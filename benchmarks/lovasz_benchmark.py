@@ -0,0 +1,95 @@
+'''
+# ------------------------------------------
+# Benchmark: per-image Lovasz hinge, looped vs batched
+# ------------------------------------------
+
+Checks that lovasz_hinge_batched matches the per-image reference loop (loss
+and logit gradients), then times forward + backward and, on CUDA, peak
+memory for both at several batch sizes.
+
+Run from the repository root:
+    python -m benchmarks.lovasz_benchmark -batch_sizes 8 16 24 32 -crop 460
+'''
+
+import argparse
+import time
+
+import torch
+
+import LovaszSoftmax.pytorch.lovasz_losses as L
+
+IGNORE = 255
+
+
+def make_batch(batch_size, crop, device, nodata_frac=0.1):
+    logits = torch.randn(batch_size, crop, crop, device=device, requires_grad=True)
+    labels = (torch.rand(batch_size, crop, crop, device=device) > 0.7).long()
+    labels[torch.rand(batch_size, crop, crop, device=device) < nodata_frac] = IGNORE
+    return logits, labels
+
+
+def step(logits, labels, batched):
+    logits.grad = None
+    loss = L.lovasz_hinge(logits, labels, per_image=True, ignore=IGNORE, batched=batched)
+    loss.backward()
+    return loss.detach(), logits.grad.clone()
+
+
+def check(device, crop=64, batch_size=4):
+    logits, labels = make_batch(batch_size, crop, device)
+    ref_loss, ref_grad = step(logits, labels, batched=False)
+    loss, grad = step(logits, labels, batched=True)
+    print('loss: reference {:.6f}, batched {:.6f}, max |grad diff| {:.2e}'.format(
+        ref_loss.item(), loss.item(), (grad - ref_grad).abs().max().item()))
+    assert torch.allclose(loss, ref_loss, rtol=1e-4, atol=1e-5)
+    assert torch.allclose(grad, ref_grad, rtol=1e-3, atol=1e-5)
+
+
+def time_step(logits, labels, batched, repeats, device):
+    cuda = device.type == 'cuda'
+    step(logits, labels, batched)  # warm-up
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step(logits, labels, batched)
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peak = torch.cuda.max_memory_allocated() / 1024**2 if cuda else float('nan')
+    return elapsed, peak
+
+
+def run(batch_sizes, crop, repeats, device):
+    device = torch.device(device)
+    check(device)
+    print('{:>6} {:>12} {:>12} {:>8} {:>12} {:>12}'.format(
+        'batch', 'loop (ms)', 'batched (ms)', 'speedup', 'loop MB', 'batched MB'))
+    for batch_size in batch_sizes:
+        logits, labels = make_batch(batch_size, crop, device)
+        t_loop, m_loop = time_step(logits, labels, False, repeats, device)
+        t_batch, m_batch = time_step(logits, labels, True, repeats, device)
+        print('{:>6} {:>12.1f} {:>12.1f} {:>8.2f} {:>12.1f} {:>12.1f}'.format(
+            batch_size, 1000 * t_loop, 1000 * t_batch, t_loop / t_batch, m_loop, m_batch))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-batch_sizes', default=[8, 16, 24, 32], type=int, nargs='+', required=False,
+        help='Batch sizes to time.')
+    PARSER.add_argument(
+        '-crop', default=460, type=int, required=False,
+        help='Crop size in pixels.')
+    PARSER.add_argument(
+        '-repeats', default=10, type=int, required=False,
+        help='Timed steps per configuration.')
+    PARSER.add_argument(
+        '-device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.batch_sizes, ARGS.crop, ARGS.repeats, ARGS.device)
@@ -0,0 +1,86 @@
+'''
+# ------------------------------------------
+# Benchmark: exact vs histogram Lovasz hinge
+# ------------------------------------------
+
+Times forward + backward of the exact per-image Lovasz hinge (one batched
+sort) against the O(P) histogram approximation, and reports the loss error
+next to its bound of one bin width (max error / bins) per image.
+
+Run from the repository root:
+    python -m benchmarks.lovasz_hist_benchmark -crops 460 1024 -bins 64 256 1024
+'''
+
+import argparse
+import time
+
+import torch
+
+import LovaszSoftmax.pytorch.lovasz_losses as L
+from benchmarks.lovasz_benchmark import IGNORE, make_batch
+
+
+def time_loss(fn, logits, labels, repeats, device):
+    cuda = device.type == 'cuda'
+
+    def step():
+        logits.grad = None
+        loss = fn(logits, labels)
+        loss.backward()
+        return loss.detach()
+
+    step()  # warm-up
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        loss = step()
+    if cuda:
+        torch.cuda.synchronize()
+    return loss, (time.perf_counter() - start) / repeats
+
+
+def run(batch_size, crops, bins_list, repeats, device):
+    device = torch.device(device)
+    print('{:>6} {:>6} {:>11} {:>11} {:>8} {:>10} {:>10}'.format(
+        'crop', 'bins', 'exact (ms)', 'hist (ms)', 'speedup', '|error|', 'bound'))
+    for crop in crops:
+        logits, labels = make_batch(batch_size, crop, device)
+        exact_loss, t_exact = time_loss(
+            lambda x, y: L.lovasz_hinge_batched(x, y, ignore=IGNORE), logits, labels, repeats, device)
+        with torch.no_grad():
+            errors = 1. - logits * (2. * labels.float() - 1.)
+            errors[labels == IGNORE] = 0
+            max_error = errors.reshape(batch_size, -1).max(1)[0].clamp(min=0)
+        for bins in bins_list:
+            hist_loss, t_hist = time_loss(
+                lambda x, y: L.lovasz_hinge_hist(x, y, bins=bins, ignore=IGNORE), logits, labels, repeats, device)
+            bound = (max_error / bins).mean().item()
+            error = (hist_loss - exact_loss).abs().item()
+            print('{:>6} {:>6} {:>11.1f} {:>11.1f} {:>8.2f} {:>10.2e} {:>10.2e}'.format(
+                crop, bins, 1000 * t_exact, 1000 * t_hist, t_exact / t_hist, error, bound))
+            assert error <= bound + 1e-5
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-batch_size', default=16, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-crops', default=[460, 1024], type=int, nargs='+', required=False,
+        help='Crop sizes in pixels.')
+    PARSER.add_argument(
+        '-bins', default=[64, 256, 1024], type=int, nargs='+', required=False,
+        help='Histogram bin counts.')
+    PARSER.add_argument(
+        '-repeats', default=10, type=int, required=False,
+        help='Timed steps per configuration.')
+    PARSER.add_argument(
+        '-device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, required=False,
+        help='Device to run on.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.batch_size, ARGS.crops, ARGS.bins, ARGS.repeats, ARGS.device)
@@ -0,0 +1,80 @@
+'''
+# ------------------------------------------
+# Benchmark: ONNX Runtime vs torch on CPU
+# ------------------------------------------
+
+Checks the ONNX export of a trained model (written by `evaluate.py export`)
+against torch on validation tiles, including a batch and tile size other
+than the export example to exercise the dynamic axes, then reports
+per-batch latency and tiles/s for torch and ONNX Runtime at several CPU
+thread counts.
+
+Run from the repository root:
+    python evaluate.py export -model_name my_model
+    python -m benchmarks.onnx_benchmark -model_name my_model -threads 1 2 4 8
+'''
+
+import argparse
+import time
+
+import torch
+
+from evaluate import load_model_with_weights, onnx_path
+from pipeline.export import OnnxModel, check_onnx
+from pipeline.load import get_dataloader
+
+
+def time_model(model, images, repeats):
+    with torch.no_grad():
+        model(images)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(images)
+    return (time.perf_counter() - start) / repeats
+
+
+def run(model_name, in_dir, batch_size, threads_list, repeats, channel_stats):
+    model = load_model_with_weights(model_name=model_name, channel_stats=channel_stats).cpu().eval()
+    loader = get_dataloader(in_dir=in_dir, batch_size=batch_size, split='test', channel_stats=channel_stats)
+    images = next(iter(loader))[0]
+
+    onnx_model = OnnxModel(onnx_path(model_name))
+    for batch in [images, images[:1, :, :512, :512]]:
+        err, flips = check_onnx(model, onnx_model, batch)
+        print('parity {}: max abs error {:.2e}, {:.4%} of pixels flipped'.format(
+            tuple(batch.shape), err, flips))
+
+    print('{:>8} {:<6} {:>10} {:>10}'.format('threads', 'engine', 'ms/batch', 'tiles/s'))
+    for threads in threads_list:
+        torch.set_num_threads(threads)
+        engines = [('torch', model), ('onnx', OnnxModel(onnx_path(model_name), threads=threads))]
+        for name, engine in engines:
+            elapsed = time_model(engine, images, repeats)
+            print('{:>8} {:<6} {:>10.1f} {:>10.2f}'.format(threads, name, 1000 * elapsed, len(images) / elapsed))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-model_name', type=str, required=True,
+        help='Name of a trained, exported model in the models/ directory.')
+    PARSER.add_argument(
+        '-in_dir', default='training_data', type=str, required=False,
+        help='Data directory.')
+    PARSER.add_argument(
+        '-batch_size', default=4, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-threads', default=[1, 2, 4, 8], type=int, nargs='+', required=False,
+        help='CPU thread counts to time.')
+    PARSER.add_argument(
+        '-repeats', default=5, type=int, required=False,
+        help='Timed batches per configuration.')
+    PARSER.add_argument(
+        '-channel_stats', default=None, type=str, required=False,
+        help='Channel stats file the model was trained with, if any.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.model_name, ARGS.in_dir, ARGS.batch_size, ARGS.threads, ARGS.repeats, ARGS.channel_stats)
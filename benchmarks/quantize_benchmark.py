@@ -0,0 +1,91 @@
+'''
+# ------------------------------------------
+# Benchmark: INT8 vs fp32 CPU inference
+# ------------------------------------------
+
+Runs the fp32 model and its INT8 copy (written by `evaluate.py quantize`)
+on CPU over tiles of every region in CITY_REGIONS, and reports per-region
+mean IoU (iou_binary, nodata ignored) and throughput for both.
+
+Run from the repository root:
+    python evaluate.py quantize -model_name my_model
+    python -m benchmarks.quantize_benchmark -model_name my_model -tiles_per_region 32
+'''
+
+import argparse
+import itertools
+import time
+
+import torch
+
+import LovaszSoftmax.pytorch.lovasz_losses as L
+from evaluate import CITY_REGIONS, load_model_with_weights
+from pipeline.load import get_dataloader, IGNORE_LABEL
+
+
+def score(model, batches, thresh):
+    '''
+    Mean IoU and tiles per second of model over a list of (images, masks) batches.
+    '''
+    ious, tiles, elapsed = [], 0, 0.
+    with torch.no_grad():
+        for images, masks in batches:
+            start = time.perf_counter()
+            outputs = model(images)[0]
+            elapsed += time.perf_counter() - start
+            preds = (outputs > thresh).long()
+            ious.extend(L.iou_binary(p, m, ignore=IGNORE_LABEL) for p, m in zip(preds, masks))
+            tiles += len(images)
+    return sum(ious) / len(ious), tiles / elapsed
+
+
+def run(model_name, in_dir, tiles_per_region, batch_size, threads, thresh, channel_stats):
+    torch.set_num_threads(threads)
+    models = {
+        'fp32': load_model_with_weights(model_name=model_name, channel_stats=channel_stats).cpu().eval(),
+        'int8': load_model_with_weights(model_name=model_name, channel_stats=channel_stats, int8=True).eval(),
+        }
+    print('{:<5} {:<8} {:>6} {:>10} {:>10} {:>10} {:>10}'.format(
+        'city', 'region', 'tiles', 'fp32 IoU', 'int8 IoU', 'fp32 t/s', 'int8 t/s'))
+    for city, regions in CITY_REGIONS.items():
+        for region in regions:
+            loader = get_dataloader(in_dir=in_dir, batch_size=batch_size, region=region, channel_stats=channel_stats)
+            n_batches = -(-tiles_per_region // batch_size)
+            batches = [(images, masks) for images, masks, _ in itertools.islice(loader, n_batches)]
+            if not batches:
+                continue
+            results = {name: score(model, batches, thresh) for name, model in models.items()}
+            print('{:<5} {:<8} {:>6} {:>10.4f} {:>10.4f} {:>10.2f} {:>10.2f}'.format(
+                city, region, sum(len(b[0]) for b in batches),
+                results['fp32'][0], results['int8'][0], results['fp32'][1], results['int8'][1]))
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-model_name', type=str, required=True,
+        help='Name of a trained, quantized model in the models/ directory.')
+    PARSER.add_argument(
+        '-in_dir', default='training_data', type=str, required=False,
+        help='Data directory.')
+    PARSER.add_argument(
+        '-tiles_per_region', default=32, type=int, required=False,
+        help='Tiles scored per region.')
+    PARSER.add_argument(
+        '-batch_size', default=4, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-threads', default=torch.get_num_threads(), type=int, required=False,
+        help='CPU threads.')
+    PARSER.add_argument(
+        '-thresh', default=0, type=float, required=False,
+        help='Logit threshold for a building pixel.')
+    PARSER.add_argument(
+        '-channel_stats', default=None, type=str, required=False,
+        help='Channel stats file the model was trained with, if any.')
+    ARGS = PARSER.parse_args()
+    run(ARGS.model_name, ARGS.in_dir, ARGS.tiles_per_region, ARGS.batch_size, ARGS.threads,
+        ARGS.thresh, ARGS.channel_stats)
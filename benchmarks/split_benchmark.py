@@ -0,0 +1,106 @@
+'''
+# ------------------------------------------
+# Benchmark: random train / val split
+# ------------------------------------------
+
+Compares the old split='random' path (one MyDataset with train_transform,
+random_split, then DatasetWrapper applying train/val transforms again) with
+the index-first split in get_dataloader, where each dataset has exactly one
+transform pipeline.
+
+The old path hands tensors to the second transform, which to_tensor rejects;
+to time it at all, the wrapper here converts back to PIL first, which is the
+minimum extra work the double pipeline implies.
+
+Run from the repository root:
+    python -m benchmarks.split_benchmark -in_dir training_data
+'''
+
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from pipeline.load import (
+    MyDataset, DatasetWrapper, get_dataloader, select_tiles,
+    train_transform, val_transform
+    )
+
+
+def _to_pil(transform):
+    def wrapped(image, mask):
+        return transform(transforms.functional.to_pil_image(image),
+                         transforms.functional.to_pil_image(mask))
+    return wrapped
+
+
+def legacy_loaders(in_dir, batch_size, num_workers):
+    dataset = MyDataset(in_dir=in_dir, custom_transforms=train_transform,
+                        tiles=select_tiles(in_dir))
+    train_len = int(len(dataset) * 0.8)
+    train_subset, val_subset = torch.utils.data.random_split(
+        dataset, [train_len, len(dataset) - train_len])
+    train_dataset = DatasetWrapper(train_subset, transform=_to_pil(train_transform))
+    val_dataset = DatasetWrapper(val_subset, transform=_to_pil(val_transform))
+    return (DataLoader(train_dataset, shuffle=True, batch_size=batch_size, num_workers=num_workers),
+            DataLoader(val_dataset, shuffle=False, batch_size=batch_size, num_workers=num_workers))
+
+
+def time_loader(loader, max_batches):
+    start = time.perf_counter()
+    n = 0
+    for i, (images, _, _) in enumerate(loader):
+        n += images.size(0)
+        if i + 1 >= max_batches:
+            break
+    elapsed = time.perf_counter() - start
+    return n, elapsed
+
+
+def run(in_dir, batch_size, max_batches, num_workers):
+    results = []
+    start = time.perf_counter()
+    loaders = legacy_loaders(in_dir, batch_size, num_workers)
+    results.append(('double transform', time.perf_counter() - start, loaders))
+
+    start = time.perf_counter()
+    loaders = get_dataloader(in_dir=in_dir, batch_size=batch_size, split='random')
+    for loader in loaders:
+        loader.num_workers = num_workers
+    results.append(('index-first split', time.perf_counter() - start, loaders))
+
+    print('{:<20} {:>10} {:>14} {:>14}'.format('path', 'build (s)', 'train img/s', 'val img/s'))
+    for name, build_time, (train_loader, val_loader) in results:
+        n_train, t_train = time_loader(train_loader, max_batches)
+        n_val, t_val = time_loader(val_loader, max_batches)
+        print('{:<20} {:>10.2f} {:>14.1f} {:>14.1f}'.format(
+            name, build_time, n_train / t_train, n_val / t_val))
+
+    # Same seed, same partition.
+    first = get_dataloader(in_dir=in_dir, batch_size=batch_size, split='random', seed=7)
+    second = get_dataloader(in_dir=in_dir, batch_size=batch_size, split='random', seed=7)
+    assert first[1].dataset.images == second[1].dataset.images
+    print('Partition is deterministic for a fixed seed.')
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    PARSER.add_argument(
+        '-in_dir', default='training_data', type=str, required=False,
+        help='Folder containing training images, with images and masks subdirectory.')
+    PARSER.add_argument(
+        '-batch_size', default=16, type=int, required=False,
+        help='Batch size.')
+    PARSER.add_argument(
+        '-batches', default=20, type=int, required=False,
+        help='Number of batches timed per loader.')
+    PARSER.add_argument(
+        '-workers', default=0, type=int, required=False,
+        help='Loader workers (0 measures per-sample cost in the main process).')
+    ARGS = PARSER.parse_args()
+    run(ARGS.in_dir, ARGS.batch_size, ARGS.batches, ARGS.workers)
@@ -1,5 +1,6 @@
 import csv
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 import sys,os
@@ -10,7 +11,15 @@ from tqdm import tqdm
 import pdb
 
 import pipeline.criterion as Criterion
-from pipeline.load import get_dataloader
+from pipeline.load import get_dataloader, MyDataset, TileImageDataset, tile_transform, IGNORE_LABEL
+from pipeline.stats import load_channel_stats
+from pipeline.index import TILE_SOURCES, scan_dir
+from pipeline.autotune import load_loader_profile, loader_kwargs
+from pipeline.prefetch import DevicePrefetcher
+from pipeline.fuse import prepare_inference
+from pipeline.export import export_onnx, check_onnx, OnnxModel
+from pipeline.amp import amp_dtype, AutocastModel
+from torch.utils.data import DataLoader
 import pipeline.network as Network
 import LovaszSoftmax.pytorch.lovasz_losses as L
 
@@ -68,9 +77,19 @@ def img_frombytes(data):
     databytes = np.packbits(data, axis=1)
     return Image.frombytes(mode='1', size=size, data=databytes)
 
-def load_model_with_weights(model_name=None, num_epochs=8, batch_size=16, use_lovasz=True, se_loss=False, aux=False):
+def load_model_with_weights(model_name=None, num_epochs=8, batch_size=16, use_lovasz=True, se_loss=False, aux=False, channel_stats=None, fuse=False, int8=False, backend='torch', threads=None, amp=None, jit=False, example_dir='training_data'):
     '''
     Load a model by name from the /models subdirectory.
+
+    fuse: fold BatchNorm layers into the convolutions for inference, checking
+        the outputs against the unfused model on a validation tile from
+        example_dir (raises if they diverge). With jit, the fused model is
+        also traced, frozen and optimized for inference on the device it will
+        run on; the traced graph assumes whole 1024 x 1024 tiles.
+    int8: load the quantized weights written by the quantize command instead.
+    backend: 'onnx' to run the model exported by the export command in an
+        ONNX Runtime CPU session with the given number of threads.
+    amp: 'bf16' or 'fp16' to predict under autocast (torch float models only).
     '''
 
     options = {
@@ -124,20 +143,95 @@ def load_model_with_weights(model_name=None, num_epochs=8, batch_size=16, use_lo
         'mode': 'testval',
         'ms': False, # 'multi scale & flip'
         'no_val': False, # 'skip validation during training'
-    }
 
-    model_args = ObjectView(options)
-    model = Network.get_model(model_args)
+        # input normalization (stats file the model was trained with)
+        'channel_stats': channel_stats,
+    }
 
     if model_name[-5:] == '_m.pt':
         model_name = model_name[:-5]
 
+    if backend == 'onnx':
+        return OnnxModel(onnx_path(model_name), threads=threads)
+
+    model_args = ObjectView(options)
+    model = Network.get_model(model_args)
+
     path_to_state_dict = 'models/{}/{}_m.pt'.format(model_name, model_name)
     model.load_state_dict(torch.load(path_to_state_dict))
 
+    if int8:
+        from pipeline.quantize import load_quantized
+        model = load_quantized(model, quantized_path(model_name))
+    elif fuse:
+        device = inference_device(model)
+        example = example_tile(example_dir, channel_stats=channel_stats).to(device)
+        model = prepare_inference(model.to(device), example=example, jit=jit)
+
+    if amp is not None and not int8:
+        model = AutocastModel(model, amp_dtype(amp, inference_device(model)))
+
     return model
 
 
+def example_tile(in_dir='training_data', channel_stats=None):
+    '''
+    First whole validation tile as a (1, 3, H, W) batch, normalized like the eval loaders.
+    '''
+    dataset = MyDataset(
+        in_dir=in_dir, custom_transforms=tile_transform, split='test',
+        channel_stats=load_channel_stats(channel_stats) if channel_stats is not None else None
+        )
+    return dataset[0][0].unsqueeze(0)
+
+
+def quantized_path(model_name):
+    return 'models/{}/{}_int8.pt'.format(model_name, model_name)
+
+
+def onnx_path(model_name):
+    return 'models/{}/{}.onnx'.format(model_name, model_name)
+
+
+def inference_device(model):
+    '''
+    CUDA when available, except for INT8 and ONNX models, which only run on CPU.
+    '''
+    from pipeline.quantize import is_quantized
+    if torch.cuda.is_available() and isinstance(model, torch.nn.Module) and not is_quantized(model):
+        return torch.device('cuda')
+    return torch.device('cpu')
+
+
+def quantize(model, model_name, in_dir='training_data', num_tiles=256, batch_size=8, backend='x86', channel_stats=None):
+    '''
+    Calibrate on validation tiles and save an INT8 copy of the model for CPU inference.
+    '''
+    from pipeline.quantize import quantize_model, save_quantized
+    calib_loader = get_dataloader(
+        in_dir=in_dir, batch_size=batch_size, split='test', channel_stats=channel_stats
+        )
+    quantized = quantize_model(model, calib_loader, num_tiles=num_tiles, backend=backend)
+    save_quantized(quantized, quantized_path(model_name))
+    return quantized
+
+
+def export(model, model_name, in_dir='training_data', tile_size=1024, check_tiles=8, channel_stats=None):
+    '''
+    Export the model to ONNX and check ONNX Runtime against torch on validation tiles.
+    '''
+    path = export_onnx(model, onnx_path(model_name), tile_size=tile_size)
+    if check_tiles:
+        check_loader = get_dataloader(
+            in_dir=in_dir, batch_size=check_tiles, split='test', channel_stats=channel_stats
+            )
+        images = next(iter(check_loader))[0]
+        err, flips = check_onnx(model, OnnxModel(path), images)
+        print('ONNX matches torch on {} tiles: max abs error {:.2e}, {:.4%} of pixels flipped.'.format(
+            len(images), err, flips))
+    return path
+
+
 def output_to_pred_imgs(output, dim=0, use_lovasz=False):
     
     if use_lovasz:
@@ -154,7 +248,7 @@ def get_single_pred(model, img_name=None, img_path = None):
     '''
     
     test_img_dir = 'submission_data/test'
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    device = inference_device(model)
     # Predict on a sample image.
     if img_path is None:
         if img_name is None:
@@ -187,7 +281,7 @@ def predict_test_set(model, model_name, overwrite=False, use_lovasz=False):
         print('Exiting...')
         sys.exit()
     
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    device = inference_device(model)
     model.to(device)
 
     model.eval()
@@ -211,7 +305,7 @@ def predict_test_set(model, model_name, overwrite=False, use_lovasz=False):
 
     return None
 
-def predict_custom(model, model_name, in_dir, out_dir, overwrite=False, use_lovasz=True):
+def predict_custom(model, model_name, in_dir, out_dir, overwrite=False, use_lovasz=True, channel_stats=None):
     '''
     Predict for the entire submission set.
     '''
@@ -220,14 +314,14 @@ def predict_custom(model, model_name, in_dir, out_dir, overwrite=False, use_lova
 
     test_dataloader = get_dataloader(
         in_dir=in_dir, batch_size=8, 
-        overwrite=overwrite, out_dir=out_dir
+        overwrite=overwrite, out_dir=out_dir, channel_stats=channel_stats
         )
 
     if not test_dataloader:
         print('Exiting...')
         sys.exit()
     
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    device = inference_device(model)
     model.to(device)
 
     model.eval()
@@ -256,15 +350,15 @@ def predict_custom(model, model_name, in_dir, out_dir, overwrite=False, use_lova
     return None
 
 
-def score_region(model, model_name, region, thresh=0):
+def score_region(model, model_name, region, thresh=0, channel_stats=None):
     '''
     evaluate and score for a single region. save results.
     '''
 
     test_dataloader = get_dataloader(
-        in_dir='training_data', batch_size=8, region=region
+        in_dir='training_data', batch_size=8, region=region, channel_stats=channel_stats
         )
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    device = inference_device(model)
     model.to(device)
 
     print('Beginning Prediction Loop')
@@ -287,7 +381,7 @@ def score_region(model, model_name, region, thresh=0):
                 masks = masks.to(device)
 
                 for i, img_name in enumerate(np.array(img_names)):
-                    loss = L.iou_binary(outputs[i], masks[i])
+                    loss = L.iou_binary(outputs[i], masks[i], ignore=IGNORE_LABEL)
                     region_loss += loss
                     region_ct += 1
                     img_name = img_name.split('/')[-1]
@@ -299,6 +393,90 @@ def score_region(model, model_name, region, thresh=0):
     return None
 
 
+PSEUDO_INDEX_FILE = 'pseudolabels.csv'
+PSEUDO_FIELDS = ['key', 'confidence', 'building_frac', 'model']
+
+
+def write_pseudolabel(pred, out_path):
+    '''
+    Save a boolean mask as a bit-packed 1-bit PNG, atomically.
+    '''
+    tmp_path = out_path + '.tmp'
+    img_frombytes(pred).save(tmp_path, format='PNG', optimize=False)
+    os.replace(tmp_path, out_path)
+
+
+def pseudolabel_tier2(model, model_name, in_dir='training_data', batch_size=32, thresh=0, overwrite=False, num_writers=4):
+    '''
+    Pseudo-label tier 2 tiles in large batches, skipping tiles already labeled.
+
+    Decoding runs in loader workers, host-to-device copies are prefetched and
+    PNG encoding plus writes run on a thread pool, so reading, inference and
+    writing overlap. Each tile gets a confidence score (mean of
+    |2 * sigmoid(logit) - 1|), recorded with its building fraction in
+    tier2/pseudolabels.csv.
+    '''
+    img_dir, img_suffix, label_dir, label_suffix = TILE_SOURCES['tier2']
+    img_dir, label_dir = os.path.join(in_dir, img_dir), os.path.join(in_dir, label_dir)
+    index_path = os.path.join(in_dir, 'tier2', PSEUDO_INDEX_FILE)
+    os.makedirs(label_dir, exist_ok=True)
+
+    images = scan_dir(img_dir, img_suffix)
+    done = set()
+    if not overwrite and os.path.exists(index_path):
+        # Rows are only written after their label file, so a row means done.
+        with open(index_path, newline='') as f:
+            done = {row['key'] for row in csv.DictReader(f)}
+    todo = sorted(key for key in images if key not in done)
+    print('{} tier 2 tiles, {} to label.'.format(len(images), len(todo)))
+    if not todo:
+        return None
+
+    dataset = TileImageDataset([images[key] for key in todo])
+    loader = DataLoader(dataset, shuffle=False, batch_size=batch_size, **loader_kwargs(load_loader_profile()))
+
+    device = inference_device(model)
+    model.to(device)
+    model.eval()
+
+    write_header = overwrite or not os.path.exists(index_path)
+    with open(index_path, 'w' if overwrite else 'a', newline='') as csvfile, \
+            ThreadPoolExecutor(max_workers=num_writers) as pool:
+        csvwriter = csv.DictWriter(csvfile, fieldnames=PSEUDO_FIELDS)
+        if write_header:
+            csvwriter.writeheader()
+
+        pending = []
+        tbar = tqdm(DevicePrefetcher(loader, device))
+        for images_batch, paths in tbar:
+            with torch.no_grad():
+                logits = model(images_batch)[0][:, 0]
+                preds = (logits > thresh)
+                confidence = (2 * torch.sigmoid(logits) - 1).abs().mean((1, 2))
+                building_frac = preds.float().mean((1, 2))
+            preds = preds.cpu().numpy()
+            confidence, building_frac = confidence.tolist(), building_frac.tolist()
+
+            for pred, path, conf, frac in zip(preds, paths, confidence, building_frac):
+                key = os.path.basename(path)[:-len(img_suffix)]
+                out_path = os.path.join(label_dir, key + label_suffix)
+                row = {'key': key, 'confidence': conf, 'building_frac': frac, 'model': model_name}
+                pending.append((pool.submit(write_pseudolabel, pred, out_path), row))
+
+            # Record finished writes; keep at most a few batches in flight.
+            while pending and (pending[0][0].done() or len(pending) > 4 * batch_size):
+                future, row = pending.pop(0)
+                future.result()
+                csvwriter.writerow(row)
+            csvfile.flush()
+
+        for future, row in pending:
+            future.result()
+            csvwriter.writerow(row)
+
+    return None
+
+
 if __name__=='__main__':
     try:
         print("Clearing cuda cache.")
@@ -311,6 +489,31 @@ if __name__=='__main__':
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
+    parser.add_argument(
+        '-channel_stats', default=None, type=str, required=False,
+        help='Channel stats file the model was trained with, if any.')
+    parser.add_argument(
+        '-fuse', default=False, type=bool, required=False,
+        help='If True, fold BatchNorm layers into the convolutions before predicting \
+                (checked against the unfused model on a validation tile).')
+    parser.add_argument(
+        '-jit', default=False, type=bool, required=False,
+        help='With -fuse, also trace, freeze and optimize the fused model for 1024 x 1024 tiles.')
+    parser.add_argument(
+        '-example_dir', default='training_data', type=str, required=False,
+        help='Data directory with the validation tile used to check the -fuse model.')
+    parser.add_argument(
+        '-int8', default=False, type=bool, required=False,
+        help='If True, predict on CPU with the weights saved by the quantize command.')
+    parser.add_argument(
+        '-backend', default='torch', type=str, required=False, choices=['torch', 'onnx'],
+        help='Run the torch model, or the model saved by the export command in ONNX Runtime.')
+    parser.add_argument(
+        '-threads', default=None, type=int, required=False,
+        help='ONNX Runtime intra-op threads (default: all cores).')
+    parser.add_argument(
+        '-amp', default=None, type=str, required=False, choices=['bf16', 'fp16'],
+        help='Predict under autocast (bf16 on CPU; fp16 or bf16 on GPU).')
     subparsers = parser.add_subparsers(dest='command')
 
     test_parser = subparsers.add_parser('test', help=predict_test_set.__doc__)
@@ -347,25 +550,98 @@ if __name__=='__main__':
             '-model_name', default=None, type=str, required=True,
             help='Name of model weights file in models directory')
     
+    pseudo_parser = subparsers.add_parser('pseudolabel', help=pseudolabel_tier2.__doc__)
+    pseudo_parser.add_argument(
+            '-model_name', default=None, type=str, required=True,
+            help='Name of model weights file in models directory')
+    pseudo_parser.add_argument(
+            '-in_dir', default='training_data', type=str, required=False,
+            help='Data directory containing tier2/images.')
+    pseudo_parser.add_argument(
+            '-batch_size', default=32, type=int, required=False,
+            help='Inference batch size.')
+    pseudo_parser.add_argument(
+            '-thresh', default=0, type=float, required=False,
+            help='Logit threshold for a building pixel.')
+    pseudo_parser.add_argument(
+            '-overwrite', default=False, type=bool, required=False,
+            help='If True, relabel tiles that already have pseudo-labels.')
+
+    quant_parser = subparsers.add_parser('quantize', help=quantize.__doc__)
+    quant_parser.add_argument(
+            '-model_name', default=None, type=str, required=True,
+            help='Name of model weights file in models directory')
+    quant_parser.add_argument(
+            '-in_dir', default='training_data', type=str, required=False,
+            help='Data directory to draw validation tiles from.')
+    quant_parser.add_argument(
+            '-calib_tiles', default=256, type=int, required=False,
+            help='Number of tiles to calibrate on.')
+    quant_parser.add_argument(
+            '-engine', default='x86', type=str, required=False,
+            help='Quantized engine (x86, fbgemm, qnnpack).')
+
+    export_parser = subparsers.add_parser('export', help=export.__doc__)
+    export_parser.add_argument(
+            '-model_name', default=None, type=str, required=True,
+            help='Name of model weights file in models directory')
+    export_parser.add_argument(
+            '-in_dir', default='training_data', type=str, required=False,
+            help='Data directory to draw validation tiles from for the parity check.')
+    export_parser.add_argument(
+            '-check_tiles', default=8, type=int, required=False,
+            help='Number of tiles to compare ONNX Runtime and torch on (0 to skip).')
+
     custom_args = parser.parse_args()
 
     if custom_args.command == 'test':
-        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=custom_args.use_lovasz)
+        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=custom_args.use_lovasz,
+                channel_stats=custom_args.channel_stats, fuse=custom_args.fuse, int8=custom_args.int8,
+                backend=custom_args.backend, threads=custom_args.threads, amp=custom_args.amp,
+                jit=custom_args.jit, example_dir=custom_args.example_dir)
         MODEL.eval()
         predict_test_set(model=MODEL, model_name=custom_args.model_name, use_lovasz=custom_args.use_lovasz)
     
     elif custom_args.command =='custom':
-        MODEL = load_model_with_weights(model_name=custom_args.model_name)
+        MODEL = load_model_with_weights(model_name=custom_args.model_name, channel_stats=custom_args.channel_stats, fuse=custom_args.fuse, int8=custom_args.int8,
+                backend=custom_args.backend, threads=custom_args.threads, amp=custom_args.amp,
+                jit=custom_args.jit, example_dir=custom_args.example_dir)
         MODEL.eval()
         predict_custom(model=MODEL, model_name=custom_args.model_name, in_dir=custom_args.in_dir, 
-                out_dir=custom_args.out_dir)
+                out_dir=custom_args.out_dir, channel_stats=custom_args.channel_stats)
     
     elif custom_args.command =='region':
-        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=True, se_loss=False, aux=False)
+        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=True, se_loss=False, aux=False,
+                channel_stats=custom_args.channel_stats, fuse=custom_args.fuse, int8=custom_args.int8,
+                backend=custom_args.backend, threads=custom_args.threads, amp=custom_args.amp,
+                jit=custom_args.jit, example_dir=custom_args.example_dir)
         MODEL.eval()
         for CITY in CITY_REGIONS.keys():
             for REGION in CITY_REGIONS[CITY].keys():
-                score_region(MODEL,custom_args.model_name, REGION)
+                score_region(MODEL,custom_args.model_name, REGION, channel_stats=custom_args.channel_stats)
 
+    elif custom_args.command == 'pseudolabel':
+        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=True,
+                channel_stats=custom_args.channel_stats, fuse=custom_args.fuse, int8=custom_args.int8,
+                backend=custom_args.backend, threads=custom_args.threads, amp=custom_args.amp,
+                jit=custom_args.jit, example_dir=custom_args.example_dir)
+        MODEL.eval()
+        pseudolabel_tier2(MODEL, custom_args.model_name, in_dir=custom_args.in_dir,
+                batch_size=custom_args.batch_size, thresh=custom_args.thresh,
+                overwrite=custom_args.overwrite)
 
-    
+    elif custom_args.command == 'quantize':
+        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=True,
+                channel_stats=custom_args.channel_stats)
+        MODEL.eval()
+        quantize(MODEL, custom_args.model_name, in_dir=custom_args.in_dir,
+                num_tiles=custom_args.calib_tiles, backend=custom_args.engine,
+                channel_stats=custom_args.channel_stats)
+
+    elif custom_args.command == 'export':
+        MODEL = load_model_with_weights(model_name=custom_args.model_name, use_lovasz=True,
+                channel_stats=custom_args.channel_stats, fuse=custom_args.fuse,
+                example_dir=custom_args.example_dir)
+        MODEL.eval()
+        export(MODEL, custom_args.model_name, in_dir=custom_args.in_dir,
+                check_tiles=custom_args.check_tiles, channel_stats=custom_args.channel_stats)
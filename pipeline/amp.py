@@ -0,0 +1,72 @@
+
+import contextlib
+import torch
+from torch import nn
+
+# ---- Mixed Precision ----
+
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def amp_dtype(precision, device):
+    '''
+    Autocast dtype for precision ('bf16', 'fp16' or None) on device.
+
+    CPU autocast only runs bfloat16, so fp16 falls back to it there. On CUDA
+    bf16 falls back to fp16 on GPUs without bfloat16 support.
+    '''
+    if precision is None:
+        return None
+    dtype = AMP_DTYPES[precision]
+    device = torch.device(device)
+    if device.type == 'cpu' and dtype == torch.float16:
+        print('fp16 autocast is not supported on CPU, using bf16.')
+        dtype = torch.bfloat16
+    elif device.type == 'cuda' and dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported():
+        print('bf16 is not supported on this GPU, using fp16.')
+        dtype = torch.float16
+    return dtype
+
+
+def autocast(device, dtype):
+    '''
+    Autocast context for device, or a no-op when dtype is None.
+
+    Under autocast, convolutions and matmuls run in dtype. BatchNorm keeps
+    fp32 weights and running statistics and accumulates its batch statistics
+    in fp32. The Encoding layer disables autocast and runs in fp32.
+    '''
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+
+
+def grad_scaler(dtype):
+    '''
+    Loss scaler for fp16 training; a pass-through for bf16 and fp32.
+    '''
+    return torch.cuda.amp.GradScaler(enabled=dtype == torch.float16)
+
+
+def to_float(outputs):
+    '''
+    Cast model outputs back to fp32, so losses (e.g. the Lovasz cumsum) run in fp32.
+    '''
+    if isinstance(outputs, (tuple, list)):
+        return type(outputs)(o.float() for o in outputs)
+    return outputs.float()
+
+
+class AutocastModel(nn.Module):
+    '''
+    Runs model under autocast and returns fp32 outputs, for the predict paths.
+    '''
+    def __init__(self, model, dtype):
+        super(AutocastModel, self).__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, x, *args, **kwargs):
+        with autocast(x.device, self.dtype):
+            outputs = self.model(x, *args, **kwargs)
+        return to_float(outputs)
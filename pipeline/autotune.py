@@ -0,0 +1,142 @@
+
+import itertools
+import json
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# ---- DataLoader Profiles ----
+
+PROFILE_FILE = 'loader_profile.json'
+LOADER_KEYS = ['num_workers', 'prefetch_factor', 'persistent_workers', 'pin_memory']
+LOADER_DEFAULTS = {'num_workers': 3, 'pin_memory': True}
+
+
+def load_loader_profile(path=PROFILE_FILE):
+    '''
+    Read a saved loader profile, or {} when there is none.
+    '''
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def loader_kwargs(profile=None):
+    '''
+    DataLoader keyword arguments from a profile, falling back to the defaults.
+    '''
+    kwargs = dict(LOADER_DEFAULTS)
+    if profile:
+        kwargs.update({k: profile[k] for k in LOADER_KEYS if k in profile})
+    if kwargs['num_workers'] == 0:
+        kwargs.pop('prefetch_factor', None)
+        kwargs.pop('persistent_workers', None)
+    return kwargs
+
+
+# ---- Autotuning ----
+
+def _cpu_seconds():
+    '''
+    CPU time of this process and its (loader worker) children.
+
+    Workers that already exited are in the children_* times of this process;
+    live ones are read directly.
+    '''
+    if psutil is not None:
+        proc = psutil.Process()
+        times = proc.cpu_times()
+        total = (times.user + times.system +
+                 getattr(times, 'children_user', 0.0) + getattr(times, 'children_system', 0.0))
+        for child in proc.children(recursive=True):
+            try:
+                total += sum(child.cpu_times()[:2])
+            except psutil.NoSuchProcess:
+                pass
+        return total
+    # Without psutil only reaped children are counted, i.e. after workers exit.
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def time_config(dataset, config, max_batches=20, epochs=2):
+    '''
+    Time a few short passes over dataset with one loader configuration.
+
+    Several passes are timed so that worker start-up, which persistent
+    workers avoid after the first epoch, is part of the measurement.
+    '''
+    loader = DataLoader(dataset, shuffle=True, batch_size=config['batch_size'],
+                        **loader_kwargs(config))
+    samples = 0
+    cpu_start = _cpu_seconds()
+    start = time.perf_counter()
+    for _ in range(epochs):
+        for i, batch in enumerate(loader):
+            samples += batch[0].size(0)
+            if i + 1 >= max_batches:
+                break
+    elapsed = time.perf_counter() - start
+    cpu = _cpu_seconds() - cpu_start
+    del loader
+
+    return {
+        'samples_per_sec': samples / elapsed,
+        'cpu_util': cpu / (elapsed * (os.cpu_count() or 1)),
+        'seconds': elapsed,
+        }
+
+
+def autotune_loader(dataset, num_workers=(0, 2, 4, 8), prefetch_factor=(2, 4),
+                    persistent_workers=(False, True), pin_memory=(True, False),
+                    batch_size=(8, 16), max_batches=20, epochs=2, out_path=PROFILE_FILE):
+    '''
+    Grid search over loader settings on this machine and dataset.
+
+    Prints samples/sec and CPU utilization for every configuration tried and
+    saves the fastest one to out_path, where get_dataloader picks up its
+    loader settings. The batch size is recorded too, but training only uses
+    it when asked to (train.py all -profile_batch True).
+    '''
+    configs = []
+    for workers, pin, batch in itertools.product(num_workers, pin_memory, batch_size):
+        if workers == 0:
+            configs.append({'num_workers': 0, 'pin_memory': pin, 'batch_size': batch})
+            continue
+        for prefetch, persistent in itertools.product(prefetch_factor, persistent_workers):
+            configs.append({
+                'num_workers': workers, 'prefetch_factor': prefetch,
+                'persistent_workers': persistent, 'pin_memory': pin, 'batch_size': batch,
+                })
+
+    pin_memory_ok = torch.cuda.is_available()
+    print('{:>7} {:>8} {:>10} {:>4} {:>5} {:>10} {:>6}'.format(
+        'workers', 'prefetch', 'persistent', 'pin', 'batch', 'samples/s', 'cpu%'))
+    results = []
+    for config in configs:
+        if config['pin_memory'] and not pin_memory_ok:
+            continue
+        result = time_config(dataset, config, max_batches=max_batches, epochs=epochs)
+        results.append((config, result))
+        print('{:>7} {:>8} {:>10} {:>4} {:>5} {:>10.1f} {:>6.1f}'.format(
+            config['num_workers'], config.get('prefetch_factor', '-'),
+            str(config.get('persistent_workers', '-')), str(config['pin_memory']),
+            config['batch_size'], result['samples_per_sec'], 100 * result['cpu_util']))
+
+    best, best_result = max(results, key=lambda r: r[1]['samples_per_sec'])
+    profile = dict(best, **best_result)
+    print('Best configuration:', profile)
+
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        print('Saved loader profile to {}'.format(out_path))
+    return profile, results
@@ -0,0 +1,198 @@
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import torch
+
+# ---- Shared Decoded Tile Cache ----
+
+IMAGE_BYTES = 1024 * 1024 * 3
+MASK_BYTES = 1024 * 1024
+
+def path_key(path):
+    '''
+    Stable signed 64-bit key for a file path.
+    '''
+    digest = hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class SharedTileCache(object):
+    '''
+    Decoded uint8 tile cache shared by every DataLoader worker.
+
+    Tiles are stored in fixed-size slots of a single shared-memory tensor,
+    allocated up front from a byte budget, so one cache should hold arrays of
+    one kind (see TileCache). Slots are found through an open-addressing hash
+    table from path key to slot, and eviction uses the CLOCK algorithm. The
+    whole state lives in shared tensors and survives worker restarts between
+    epochs.
+    '''
+    def __init__(self, max_bytes, slot_bytes=IMAGE_BYTES):
+        self.slot_bytes = int(slot_bytes)
+        self.num_slots = max(1, int(max_bytes) // self.slot_bytes)
+        # At most half full, so probe sequences stay short.
+        self.table_size = 2 * self.num_slots
+
+        self.data = torch.zeros(self.num_slots, self.slot_bytes, dtype=torch.uint8).share_memory_()
+        self.keys = torch.zeros(self.num_slots, dtype=torch.int64).share_memory_()
+        self.shapes = torch.zeros(self.num_slots, 3, dtype=torch.int64).share_memory_()
+        self.used = torch.zeros(self.num_slots, dtype=torch.bool).share_memory_()
+        self.ref = torch.zeros(self.num_slots, dtype=torch.bool).share_memory_()
+        # Hash table of slot + 1, 0 for an empty bucket.
+        self.table = torch.zeros(self.table_size, dtype=torch.int64).share_memory_()
+        # [clock hand, hits, misses]
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+
+    def _home(self, key):
+        return key % self.table_size
+
+    def _bucket(self, key):
+        '''
+        Bucket holding key, or the empty bucket that ends its probe sequence.
+        '''
+        bucket = self._home(key)
+        while True:
+            entry = int(self.table[bucket])
+            if entry == 0 or int(self.keys[entry - 1]) == key:
+                return bucket
+            bucket = (bucket + 1) % self.table_size
+
+    def _find(self, key):
+        entry = int(self.table[self._bucket(key)])
+        return entry - 1 if entry else None
+
+    def _remove(self, key):
+        '''
+        Delete key from the hash table, shifting later entries of its probe
+        run back so no tombstones are needed.
+        '''
+        hole = self._bucket(key)
+        if int(self.table[hole]) == 0:
+            return
+        bucket = hole
+        while True:
+            bucket = (bucket + 1) % self.table_size
+            entry = int(self.table[bucket])
+            if entry == 0:
+                break
+            home = self._home(int(self.keys[entry - 1]))
+            # Move the entry into the hole unless its home lies cyclically in (hole, bucket].
+            if (bucket - home) % self.table_size >= (bucket - hole) % self.table_size:
+                self.table[hole] = entry
+                hole = bucket
+        self.table[hole] = 0
+
+    def get(self, path):
+        '''
+        Return a copy of the cached array for path, or None on a miss.
+        '''
+        key = path_key(path)
+        with self.lock:
+            slot = self._find(key)
+            if slot is None:
+                self.counters[2] += 1
+                return None
+            shape = tuple(int(s) for s in self.shapes[slot] if s > 0)
+            size = int(np.prod(shape))
+            arr = self.data[slot, :size].numpy().reshape(shape).copy()
+            self.ref[slot] = True
+            self.counters[1] += 1
+        return arr
+
+    def put(self, path, arr):
+        '''
+        Insert a decoded uint8 array, evicting with CLOCK if the cache is full.
+        '''
+        arr = np.ascontiguousarray(arr, dtype=np.uint8)
+        if arr.nbytes > self.slot_bytes or arr.ndim > 3:
+            return False
+        key = path_key(path)
+        with self.lock:
+            if self._find(key) is not None:
+                return True
+            hand = int(self.counters[0])
+            while self.used[hand] and self.ref[hand]:
+                self.ref[hand] = False
+                hand = (hand + 1) % self.num_slots
+            slot = hand
+            self.counters[0] = (hand + 1) % self.num_slots
+            if self.used[slot]:
+                self._remove(int(self.keys[slot]))
+
+            self.data[slot, :arr.nbytes] = torch.from_numpy(arr.reshape(-1))
+            shape = list(arr.shape) + [0] * (3 - arr.ndim)
+            self.shapes[slot] = torch.tensor(shape, dtype=torch.int64)
+            self.keys[slot] = key
+            self.used[slot] = True
+            self.ref[slot] = True
+            self.table[self._bucket(key)] = slot + 1
+        return True
+
+    def stats(self):
+        '''
+        Hits, misses and hit rate since the last reset.
+        '''
+        hits, misses = int(self.counters[1]), int(self.counters[2])
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+            'slots_used': int(self.used.sum()),
+            'num_slots': self.num_slots,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters[1:] = 0
+
+    def __len__(self):
+        return int(self.used.sum())
+
+
+class TileCache(object):
+    '''
+    Separate SharedTileCaches for RGB images and for single-band masks
+    (labels and nodata), each with slots sized to its arrays.
+
+    The byte budget is split in proportion to the slot sizes, since every
+    training tile reads one image and at least one mask.
+    '''
+    SLOT_BYTES = {'image': IMAGE_BYTES, 'mask': MASK_BYTES}
+
+    def __init__(self, max_bytes):
+        total = sum(self.SLOT_BYTES.values())
+        self.caches = {
+            kind: SharedTileCache(max_bytes * slot_bytes // total, slot_bytes=slot_bytes)
+            for kind, slot_bytes in self.SLOT_BYTES.items()
+            }
+        self.num_slots = sum(c.num_slots for c in self.caches.values())
+
+    def get(self, path, kind='image'):
+        return self.caches[kind].get(path)
+
+    def put(self, path, arr, kind='image'):
+        return self.caches[kind].put(path, arr)
+
+    def stats(self):
+        '''
+        Hits, misses and hit rate since the last reset, over both caches.
+        '''
+        stats = [c.stats() for c in self.caches.values()]
+        hits, misses = sum(s['hits'] for s in stats), sum(s['misses'] for s in stats)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+            'slots_used': sum(s['slots_used'] for s in stats),
+            'num_slots': self.num_slots,
+            }
+
+    def reset_stats(self):
+        for cache in self.caches.values():
+            cache.reset_stats()
+
+    def __len__(self):
+        return sum(len(c) for c in self.caches.values())
@@ -0,0 +1,158 @@
+
+import fcntl
+import json
+import os
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# ---- Building Density Tables ----
+
+DENSITY_FILE = 'mask_density.npy'
+DENSITY_KEYS_FILE = 'mask_density.json'
+DENSITY_LOCK_FILE = '.mask_density.lock'
+CELL = 16
+TILE_SIZE = 1024
+
+
+def mask_integral(mask, cell=CELL, tile_size=TILE_SIZE):
+    '''
+    Summed-area table of building pixels, counted over cell x cell blocks.
+
+    Entry [i, j] is the number of building pixels above row i*cell and left
+    of column j*cell, so any cell-aligned rectangle sums in O(1).
+    '''
+    mask = np.asarray(mask)
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    fg = np.zeros((tile_size, tile_size), dtype=np.int32)
+    h, w = min(mask.shape[0], tile_size), min(mask.shape[1], tile_size)
+    # 1-bit masks (tier 2 pseudo-labels) come through as bool.
+    fg[:h, :w] = mask[:h, :w] if mask.dtype == bool else mask[:h, :w] > 127
+    grid = tile_size // cell
+    blocks = fg.reshape(grid, cell, grid, cell).sum((1, 3))
+    sat = np.zeros((grid + 1, grid + 1), dtype=np.int32)
+    sat[1:, 1:] = blocks.cumsum(0).cumsum(1)
+    return sat
+
+
+def load_density_keys(in_dir):
+    '''
+    Cell size and mask paths (in row order) of in_dir's density table, or None.
+    '''
+    keys_path = os.path.join(in_dir, DENSITY_KEYS_FILE)
+    if not (os.path.exists(keys_path) and os.path.exists(os.path.join(in_dir, DENSITY_FILE))):
+        return None
+    with open(keys_path) as f:
+        return json.load(f)
+
+
+def update_density_table(mask_paths, in_dir, cell=CELL):
+    '''
+    Decode the masks not yet in in_dir's density table once and append
+    their summed-area tables.
+
+    Tables go into a single (N, G+1, G+1) int32 .npy file next to a json list
+    of the mask paths they belong to, so loader workers can memory-map it.
+    The table only grows: rows keep their positions, so rows handed out
+    earlier stay valid. The grown table is written to a new file and swapped
+    in with os.replace, table before keys, so processes still mapping the
+    old file are not disturbed. Writers on one in_dir take turns on a lock file.
+    '''
+    grid = TILE_SIZE // cell
+    table_path = os.path.join(in_dir, DENSITY_FILE)
+    keys_path = os.path.join(in_dir, DENSITY_KEYS_FILE)
+    with open(os.path.join(in_dir, DENSITY_LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        keys = load_density_keys(in_dir)
+        if keys is not None and keys['cell'] != cell:
+            raise RuntimeError('Density table in {} uses {} px cells, not {}.'.format(in_dir, keys['cell'], cell))
+        masks = keys['masks'] if keys is not None else []
+        known = set(masks)
+        missing = [path for path in dict.fromkeys(mask_paths) if path not in known]
+        if not missing:
+            return table_path
+
+        tmp_path = table_path + '.tmp'
+        tables = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.int32, shape=(len(masks) + len(missing), grid + 1, grid + 1))
+        if masks:
+            tables[:len(masks)] = np.load(table_path, mmap_mode='r')
+        for i, path in enumerate(tqdm(missing, desc='mask density'), len(masks)):
+            tables[i] = mask_integral(Image.open(path), cell=cell)
+        tables.flush()
+        del tables
+        os.replace(tmp_path, table_path)
+
+        with open(keys_path + '.tmp', 'w') as f:
+            json.dump({'cell': cell, 'masks': masks + missing}, f)
+        os.replace(keys_path + '.tmp', keys_path)
+    return table_path
+
+
+def get_density_rows(mask_paths, in_dir, cell=CELL):
+    '''
+    Row of in_dir's density table for each mask path.
+
+    get_tile_index fills the table for every indexed mask; any mask still
+    missing (e.g. an index cached before the table existed) is appended.
+    '''
+    table_path = os.path.join(in_dir, DENSITY_FILE)
+    keys = load_density_keys(in_dir)
+    rows = {path: i for i, path in enumerate(keys['masks'])} if keys is not None else {}
+    if keys is None or keys['cell'] != cell or not all(path in rows for path in mask_paths):
+        update_density_table(mask_paths, in_dir, cell=cell)
+        keys = load_density_keys(in_dir)
+        rows = {path: i for i, path in enumerate(keys['masks'])}
+    return table_path, np.array([rows[path] for path in mask_paths], dtype=np.int64)
+
+
+class DensityCropSampler(object):
+    '''
+    Pick crop locations with a target building fraction.
+
+    Draws a few random crop candidates per tile, scores each in O(1) from the
+    tile's summed-area table and keeps the one closest to target. Crops snap
+    to the table's cell grid. Nothing is decoded to make the choice.
+    '''
+    def __init__(self, table_path, rows, target=0.2, crop_size=460, candidates=8, cell=CELL):
+        self.table_path = table_path
+        self.rows = rows
+        self.target = target
+        self.crop_size = crop_size
+        self.candidates = candidates
+        self.cell = cell
+        self._tables = None
+
+    @property
+    def tables(self):
+        # Opened lazily so each loader worker maps the file itself.
+        if self._tables is None:
+            self._tables = np.load(self.table_path, mmap_mode='r')
+        return self._tables
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tables'] = None
+        return state
+
+    def fractions(self, sat, tops, lefts):
+        '''
+        Building fraction of crops at the given (cell aligned) pixel offsets.
+        '''
+        r0, c0 = tops // self.cell, lefts // self.cell
+        span = self.crop_size // self.cell
+        r1, c1 = r0 + span, c0 + span
+        counts = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+        return counts / float((span * self.cell) ** 2)
+
+    def sample(self, index):
+        '''
+        (top, left) crop location for dataset item index.
+        '''
+        max_loc = TILE_SIZE - self.crop_size
+        locs = np.random.randint(0, max_loc, (self.candidates, 2))
+        locs = locs // self.cell * self.cell
+        sat = self.tables[self.rows[index]]
+        frac = self.fractions(sat, locs[:, 0], locs[:, 1])
+        return locs[np.argmin(np.abs(frac - self.target))]
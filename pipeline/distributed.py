@@ -0,0 +1,147 @@
+
+import contextlib
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from FastFCN.encoding.nn import SyncBatchNorm
+
+# ---- Distributed Training ----
+
+INIT_FILE = 'ddp_init'
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def get_local_world_size():
+    '''
+    Number of ranks on this node.
+    '''
+    return int(os.environ.get('LOCAL_WORLD_SIZE', 1)) if is_distributed() else 1
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    '''
+    Run the body on rank 0 first and on the other ranks once it is done.
+
+    For data preparation that writes caches (tile index, density tables):
+    rank 0 builds them, the other ranks then find them valid and only read.
+    The data directory must be shared by all nodes, like the init file.
+    '''
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def local_device():
+    '''
+    This rank's GPU when there are any (ranks share a node's GPUs round-robin), else CPU.
+    '''
+    if torch.cuda.is_available():
+        device = torch.device('cuda', get_rank() % torch.cuda.device_count())
+        torch.cuda.set_device(device)
+        return device
+    return torch.device('cpu')
+
+
+def _worker(local_rank, fn, kwargs, procs, node_rank, world_size, init_file, backend):
+    rank = node_rank * procs + local_rank
+    os.environ['LOCAL_RANK'] = str(local_rank)
+    os.environ['LOCAL_WORLD_SIZE'] = str(procs)
+    dist.init_process_group(
+        backend, init_method='file://' + os.path.abspath(init_file), rank=rank, world_size=world_size)
+    try:
+        fn(**kwargs)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn, kwargs, procs=1, nodes=1, node_rank=0, init_file=INIT_FILE, backend='gloo'):
+    '''
+    Run fn(**kwargs) as ranks node_rank * procs ... of nodes * procs processes.
+
+    The ranks meet through a file store: init_file must be on a filesystem
+    every node can see and must not exist before the run. A stale file is
+    removed on a single node; across nodes it is an error, since another
+    node may already be using it. With a single process fn just runs here.
+    '''
+    world_size = procs * nodes
+    if world_size == 1:
+        return fn(**kwargs)
+    if os.path.exists(init_file):
+        if nodes > 1:
+            raise RuntimeError('init file {} already exists; remove it before launching.'.format(init_file))
+        os.remove(init_file)
+    mp.spawn(_worker, args=(fn, kwargs, procs, node_rank, world_size, init_file, backend),
+             nprocs=procs, join=True)
+    return None
+
+
+def prepare_model(model):
+    '''
+    Swap BatchNorm layers for SyncBatchNorm, which reduces batch statistics
+    over the process group; a no-op outside distributed training.
+    '''
+    if not is_distributed():
+        return model
+    return SyncBatchNorm.convert_sync_batchnorm(model)
+
+
+def wrap_model(model, device):
+    '''
+    DistributedDataParallel over the parameters that currently require grad.
+
+    DDP fixes its parameter set when it is built, so the model is wrapped
+    again whenever layers are unfrozen. Outside distributed training the
+    model is returned as is.
+    '''
+    if not is_distributed():
+        return model
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids)
+
+
+def all_reduce_sum(values, device):
+    '''
+    Element-wise sum of a list of numbers over all ranks.
+    '''
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor)
+    return tensor.tolist()
+
+
+def broadcast_flag(flag, device):
+    '''
+    Rank 0's value of a boolean, on every rank.
+    '''
+    if not is_distributed():
+        return flag
+    tensor = torch.tensor([int(flag)], device=device)
+    dist.broadcast(tensor, 0)
+    return bool(tensor.item())
@@ -0,0 +1,96 @@
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# ---- ONNX Export ----
+
+ONNX_OPSET = 17
+INPUT_NAME, OUTPUT_NAME = 'image', 'logits'
+DYNAMIC_AXES = {
+    INPUT_NAME: {0: 'batch', 2: 'height', 3: 'width'},
+    OUTPUT_NAME: {0: 'batch', 2: 'height', 3: 'width'},
+    }
+
+
+class SegmentationOutput(nn.Module):
+    '''
+    Model returning only the segmentation logits, the one output exported.
+    '''
+    def __init__(self, model):
+        super(SegmentationOutput, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+def export_onnx(model, path, tile_size=1024, opset=ONNX_OPSET):
+    '''
+    Export the segmentation output of model to ONNX with dynamic batch and tile size.
+
+    scaled_l2 and aggregate export through their symbolic() methods as plain
+    MatMul / ReduceSum graphs, so no custom ONNX operators are needed.
+    '''
+    model = SegmentationOutput(model).cpu().eval()
+    example = torch.rand(1, 3, tile_size, tile_size)
+    with torch.no_grad():
+        torch.onnx.export(
+            model, example, path, opset_version=opset,
+            input_names=[INPUT_NAME], output_names=[OUTPUT_NAME],
+            dynamic_axes=DYNAMIC_AXES, do_constant_folding=True,
+            )
+    print('Exported ONNX model to {}'.format(path))
+    return path
+
+
+class OnnxModel(object):
+    '''
+    ONNX Runtime CPU session with the calling convention of the torch model.
+
+    Called on an image batch it returns a one-element tuple of logits, and
+    to() / eval() are no-ops, so the predict functions in evaluate.py take it
+    in place of the network.
+    '''
+    def __init__(self, path, threads=None):
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required to run ONNX models.')
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, images):
+        images = np.ascontiguousarray(images.detach().cpu().numpy(), dtype=np.float32)
+        logits = self.session.run([OUTPUT_NAME], {INPUT_NAME: images})[0]
+        return (torch.from_numpy(logits),)
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+def check_onnx(model, onnx_model, images, rtol=1e-3, atol=1e-3):
+    '''
+    Compare ONNX Runtime logits with the torch model on a batch of images.
+
+    Returns the max abs logit difference and the fraction of pixels whose
+    building / background decision differs.
+    '''
+    model = model.cpu().eval()
+    with torch.no_grad():
+        ref = model(images.cpu())[0]
+    out = onnx_model(images)[0]
+    err = (ref - out).abs().max().item()
+    flips = ((ref > 0) != (out > 0)).float().mean().item()
+    if not torch.allclose(ref, out, rtol=rtol, atol=atol):
+        raise RuntimeError('ONNX output differs from torch (max abs error {:.2e}).'.format(err))
+    return err, flips
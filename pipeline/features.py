@@ -0,0 +1,206 @@
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from pipeline.autotune import PROFILE_FILE, load_loader_profile, loader_kwargs
+from pipeline.load import MyDataset, add_density_crops, make_loader, train_transform
+from pipeline.stats import load_channel_stats
+
+# ---- Frozen Backbone Feature Cache ----
+
+FEATURE_CACHE_DIR = 'feature_cache'
+# JPU inputs; c1 is passed through the JPU but never used by the heads.
+FEATURE_NAMES = ['c2', 'c3', 'c4']
+CROP_SIZE = 460
+META_FILE = 'meta.json'
+
+
+class FixedCrops(object):
+    '''
+    One seeded crop location per tile, in the crop_sampler interface of MyDataset.
+
+    crop_sampler: draw each tile's location once from this sampler (e.g. a
+        DensityCropSampler) instead of uniformly.
+    '''
+    def __init__(self, num_tiles, seed=0, crop_size=CROP_SIZE, tile_size=1024, crop_sampler=None):
+        if crop_sampler is None:
+            rng = np.random.RandomState(seed)
+            self.locs = rng.randint(0, tile_size - crop_size, (num_tiles, 2))
+            return
+        # Crop samplers draw from the global generator; seed it for this pass only.
+        state = np.random.get_state()
+        np.random.seed(seed)
+        self.locs = np.array([crop_sampler.sample(i) for i in range(num_tiles)])
+        np.random.set_state(state)
+
+    def sample(self, index):
+        return self.locs[index]
+
+
+def backbone_hash(model):
+    '''
+    Hash of everything that determines the backbone features: the weights and
+    running statistics of model.pretrained and the input normalization.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for name, tensor in sorted(model.pretrained.state_dict().items()):
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    h.update(str(model.normalize).encode('utf-8'))
+    h.update(model.input_mean.cpu().numpy().tobytes())
+    h.update(model.input_std.cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def cache_key(model, images, seed, channel_stats, density_target=None):
+    '''
+    Hash of what the cached features depend on: backbone, tile list, crops
+    and region normalization.
+    '''
+    h = hashlib.blake2b(digest_size=8)
+    h.update(backbone_hash(model).encode('utf-8'))
+    h.update('\n'.join(images).encode('utf-8'))
+    h.update(json.dumps({'seed': seed, 'crop_size': CROP_SIZE, 'density_target': density_target}).encode('utf-8'))
+    if channel_stats is not None:
+        with open(channel_stats, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _open_memmaps(path, meta, mode):
+    arrays = {}
+    for name, (dtype, shape) in meta['arrays'].items():
+        arrays[name] = np.lib.format.open_memmap(
+            os.path.join(path, name + '.npy'), mode=mode, dtype=dtype, shape=tuple(shape))
+    return arrays
+
+
+def build_feature_cache(model, in_dir=None, split='train', tier2=False, channel_stats=None, seed=0,
+                        batch_size=16, batch_trim=None, density_target=None, root=FEATURE_CACHE_DIR,
+                        device=None, profile_path=PROFILE_FILE):
+    '''
+    Run the frozen backbone once over a deterministic crop of every training
+    tile and store c2..c4 as fp16 memory-mapped arrays, with the crop masks.
+
+    The tiles are those of the training loader for the same batch_trim, and
+    with density_target each tile's crop is drawn once from its density
+    table, as the live loader does every epoch. Crops are seeded per tile
+    and skip color jitter. The backbone runs in eval
+    mode, so its BatchNorm layers use their running statistics rather than
+    batch statistics. Each split has one cache, root/<split>, whose meta.json
+    records the cache_key (backbone weights, tile list, crops) it was built
+    for. A complete cache with the current key is reused. Otherwise the
+    directory is deleted before the build, whether the cache is stale or
+    was left incomplete by an aborted build.
+
+    At stride 8 a 460 px crop takes about 24 MB of features, so the full
+    training split needs on the order of 1 TB; the build stops before
+    writing if the filesystem under root has less space free.
+    '''
+    dataset = MyDataset(
+        in_dir=in_dir, custom_transforms=functools.partial(train_transform, jitter=False),
+        split=split, tier2=tier2, batch_trim=batch_trim,
+        channel_stats=load_channel_stats(channel_stats) if channel_stats is not None else None
+        )
+    if density_target is not None:
+        add_density_crops(dataset, density_target)
+    dataset.crop_sampler = FixedCrops(len(dataset), seed=seed, crop_sampler=dataset.crop_sampler)
+
+    key = cache_key(model, dataset.images, seed, channel_stats, density_target)
+    path = os.path.join(root, split)
+    meta_path = os.path.join(path, META_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('complete') and meta.get('key') == key:
+            print('Using feature cache {} ({} tiles).'.format(path, meta['tiles']))
+            return path
+    if os.path.exists(path):
+        print('Removing stale feature cache {}'.format(path))
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    device = device or next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    loader = DataLoader(dataset, shuffle=False, batch_size=batch_size,
+                        **loader_kwargs(load_loader_profile(profile_path)))
+    arrays, meta, start = None, None, 0
+    with torch.no_grad():
+        for images, masks, _ in tqdm(loader, desc='caching features'):
+            features = model.backbone_forward(images.to(device))[1:]
+            if arrays is None:
+                meta = {'key': key, 'tiles': len(dataset), 'seed': seed, 'images': dataset.images,
+                        'scenes': dataset.scenes, 'arrays': {
+                    name: ('float16', [len(dataset)] + list(f.shape[1:])) for name, f in zip(FEATURE_NAMES, features)}}
+                meta['arrays']['masks'] = ('uint8', [len(dataset)] + list(masks.shape[-2:]))
+                size = sum(np.prod(shape) * np.dtype(dtype).itemsize for dtype, shape in meta['arrays'].values())
+                free = shutil.disk_usage(path).free
+                if size > free:
+                    raise RuntimeError('Feature cache needs {:.1f} GB but only {:.1f} GB are free under {}.'.format(
+                        size / 1024**3, free / 1024**3, root))
+                print('Writing {:.1f} GB of features to {}'.format(size / 1024**3, path))
+                arrays = _open_memmaps(path, meta, 'w+')
+            end = start + len(images)
+            for name, f in zip(FEATURE_NAMES, features):
+                arrays[name][start:end] = f.half().cpu().numpy()
+            arrays['masks'][start:end] = masks.reshape(len(images), *masks.shape[-2:]).round().byte().numpy()
+            start = end
+    model.train(was_training)
+
+    for array in arrays.values():
+        array.flush()
+    meta['complete'] = True
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return path
+
+
+class FeatureCacheDataset(Dataset):
+    '''
+    (c2, c3, c4, mask, image path) items from a feature cache, read from the
+    memory maps; features stay fp16 until they reach the device. Tiles keep
+    the order and scenes of the training MyDataset, so the same samplers apply.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.images = self.meta['images']
+        self.scenes = self.meta['scenes']
+        self.arrays = None
+
+    def __getitem__(self, index):
+        if self.arrays is None:
+            # Opened lazily, so every loader worker maps the files itself.
+            self.arrays = _open_memmaps(self.path, self.meta, 'r')
+        features = [torch.from_numpy(np.array(self.arrays[name][index])) for name in FEATURE_NAMES]
+        mask = torch.from_numpy(np.array(self.arrays['masks'][index])).unsqueeze(0).float()
+        return features + [mask, self.images[index]]
+
+    def __len__(self):
+        return self.meta['tiles']
+
+
+def get_feature_loader(path, batch_size=16, sampler=None, epoch_len=None, profile_path=PROFILE_FILE):
+    '''
+    Loader over a feature cache, drawing epochs like the training loader
+    (make_loader with the same sampler and epoch_len), so both run the same
+    number of steps per epoch.
+    '''
+    return make_loader(FeatureCacheDataset(path), batch_size, sampler=sampler, epoch_len=epoch_len,
+                       profile=load_loader_profile(profile_path))
+
+
+def backbone_frozen(model):
+    '''
+    True while no backbone parameter is trainable, so cached features are valid.
+    '''
+    return not any(p.requires_grad for p in model.pretrained.parameters())
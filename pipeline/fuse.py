@@ -0,0 +1,105 @@
+
+import copy
+import torch
+from torch import nn
+
+# ---- Conv-BN Folding ----
+
+def fold_conv_bn(conv, bn):
+    '''
+    Conv2d equivalent to bn(conv(x)) with the BN statistics in eval mode.
+
+    Works for grouped / depthwise convs: BN scales each output channel.
+    '''
+    fused = nn.Conv2d(
+        conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+        conv.padding, conv.dilation, conv.groups, bias=True, padding_mode=conv.padding_mode
+        ).to(conv.weight.device, conv.weight.dtype)
+    with torch.no_grad():
+        gamma = bn.weight if bn.weight is not None else torch.ones_like(bn.running_var)
+        beta = bn.bias if bn.bias is not None else torch.zeros_like(bn.running_mean)
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        scale = gamma / torch.sqrt(bn.running_var + bn.eps)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        fused.bias.copy_((bias - bn.running_mean) * scale + beta)
+    return fused
+
+
+def _last_leaf(module):
+    '''
+    (parent, name) of the last leaf module registered under module.
+    '''
+    children = list(module.named_children())
+    if not children:
+        return None, None
+    name, child = children[-1]
+    if len(list(child.children())) == 0:
+        return module, name
+    return _last_leaf(child)
+
+
+def fold_batchnorms(model):
+    '''
+    Fold every BatchNorm2d into the conv registered right before it, in place.
+
+    A BN is folded when the sibling registered before it is a Conv2d, or a
+    container whose last registered leaf is a Conv2d (e.g. the deep-base
+    ResNet stem before bn1, SeparableConv2d before the JPU norms). In this
+    network registration order follows the forward order for these pairs;
+    prepare_inference checks the result numerically. Folded BNs become
+    nn.Identity. Returns the number of BNs folded.
+    '''
+    folded = 0
+    for module in list(model.modules()):
+        prev = None
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.BatchNorm2d) and child.track_running_stats and prev is not None:
+                if isinstance(prev[1], nn.Conv2d):
+                    parent, conv_name = module, prev[0]
+                else:
+                    parent, conv_name = _last_leaf(prev[1])
+                conv = getattr(parent, conv_name) if parent is not None else None
+                if isinstance(conv, nn.Conv2d) and conv.out_channels == child.num_features:
+                    setattr(parent, conv_name, fold_conv_bn(conv, child))
+                    setattr(module, name, nn.Identity())
+                    folded += 1
+                    prev = None
+                    continue
+            prev = (name, child)
+    return folded
+
+
+def _outputs(out):
+    return out if isinstance(out, (tuple, list)) else (out,)
+
+
+def prepare_inference(model, example=None, jit=True, check=True, rtol=1e-3, atol=1e-3):
+    '''
+    Eval-mode copy of model with BNs folded into convs, optionally frozen.
+
+    With an example input and jit=True the folded model is traced, frozen and
+    passed through torch.jit.optimize_for_inference, which fuses conv + ReLU
+    where the backend supports it; the traced graph is then specific to the
+    example's input size. With check=True the outputs on example are compared
+    against the original model.
+    '''
+    model.eval()
+    fused = copy.deepcopy(model)
+    folded = fold_batchnorms(fused)
+    print('Folded {} BatchNorm layers into convolutions.'.format(folded))
+
+    if example is not None and jit:
+        with torch.no_grad():
+            traced = torch.jit.trace(fused, example)
+        fused = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    if example is not None and check:
+        with torch.no_grad():
+            ref = _outputs(model(example))
+            out = _outputs(fused(example))
+        for r, o in zip(ref, out):
+            err = (r - o).abs().max().item()
+            if not torch.allclose(r, o, rtol=rtol, atol=atol):
+                raise RuntimeError('Fused model differs from the original (max abs error {:.2e}).'.format(err))
+        print('Fused outputs match the original (max abs error {:.2e}).'.format(err))
+    return fused
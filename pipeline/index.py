@@ -0,0 +1,141 @@
+
+import os
+import pickle
+import pandas as pd
+
+from pipeline.density import update_density_table
+
+# ---- Tile Index ----
+
+INDEX_FILE = '.tile_index{}.pkl'
+# 5: building the index also fills the mask density table.
+INDEX_VERSION = 5
+INDEX_COLUMNS = ['key', 'scene', 'x', 'y', 'image', 'mask', 'nodata', 'tier2']
+
+# (image dir, image suffix, mask dir, mask suffix) relative to the data directory.
+TILE_SOURCES = {
+    'base': ('images', '_i.jpg', 'masks', '_mask.jpg'),
+    # Pseudo-labels are 1-bit PNGs written by `evaluate.py pseudolabel`.
+    'tier2': (os.path.join('tier2', 'images'), '.jpg', os.path.join('tier2', 'pseudolabels'), '.png'),
+    }
+
+# Optional 1-bit nodata masks written by ingest, only for tiles with nodata pixels.
+NODATA_SOURCES = {
+    'base': ('nodata', '_nodata.png'),
+    }
+
+
+def scan_dir(directory, suffix):
+    '''
+    Single os.scandir pass over a directory.
+
+    Returns {key: path} for every file ending in suffix, where key is the
+    file name with the suffix removed.
+    '''
+    entries = {}
+    if not os.path.isdir(directory):
+        return entries
+    with os.scandir(directory) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith('.') or not name.endswith(suffix):
+                continue
+            if entry.is_file():
+                entries[name[:-len(suffix)]] = entry.path
+    return entries
+
+
+def parse_key(key):
+    '''
+    Split a tile key like '665946_10240_2048' into (scene, x_pos, y_pos).
+
+    Keys that do not follow the pattern get -1 coordinates.
+    '''
+    if key.endswith('_i'):
+        key = key[:-2]
+    parts = key.split('_')
+    if len(parts) == 3 and parts[1].lstrip('-').isdigit() and parts[2].lstrip('-').isdigit():
+        return parts[0], int(parts[1]), int(parts[2])
+    return parts[0], -1, -1
+
+
+def _source_dirs(in_dir, tier2):
+    sources = ['base', 'tier2'] if tier2 else ['base']
+    dirs = []
+    for source in sources:
+        img_dir, _, mask_dir, _ = TILE_SOURCES[source]
+        dirs.append(os.path.join(in_dir, img_dir))
+        dirs.append(os.path.join(in_dir, mask_dir))
+        if source in NODATA_SOURCES:
+            dirs.append(os.path.join(in_dir, NODATA_SOURCES[source][0]))
+    return dirs
+
+
+def _dir_mtimes(dirs):
+    return {d: (os.stat(d).st_mtime_ns if os.path.isdir(d) else None) for d in dirs}
+
+
+def build_tile_index(in_dir, tier2=False):
+    '''
+    Scan image and mask directories once each and join them by tile key.
+
+    Only tiles with both an image and a mask are kept, sorted by key. The
+    nodata column holds the tile's nodata mask path, or None.
+    '''
+    records = []
+    sources = ['base', 'tier2'] if tier2 else ['base']
+    for source in sources:
+        img_dir, img_suffix, mask_dir, mask_suffix = TILE_SOURCES[source]
+        images = scan_dir(os.path.join(in_dir, img_dir), img_suffix)
+        masks = scan_dir(os.path.join(in_dir, mask_dir), mask_suffix)
+        nodata = {}
+        if source in NODATA_SOURCES:
+            nodata_dir, nodata_suffix = NODATA_SOURCES[source]
+            nodata = scan_dir(os.path.join(in_dir, nodata_dir), nodata_suffix)
+        for key in sorted(images.keys() & masks.keys()):
+            scene, x_pos, y_pos = parse_key(key)
+            records.append((key, scene, x_pos, y_pos, images[key], masks[key], nodata.get(key), source == 'tier2'))
+
+    index = pd.DataFrame.from_records(records, columns=INDEX_COLUMNS)
+    index['x'] = index['x'].astype('int64')
+    index['y'] = index['y'].astype('int64')
+    index['scene'] = index['scene'].astype('category')
+    index['tier2'] = index['tier2'].astype(bool)
+    return index
+
+
+def get_tile_index(in_dir, tier2=False, use_cache=True):
+    '''
+    Load the tile index for in_dir, rebuilding it if any scanned directory changed.
+
+    The index is cached in in_dir/.tile_index[_tier2].pkl with the mtimes of
+    the directories it was built from. Adding or removing files changes a
+    directory's mtime, which invalidates the cache. Each rebuild also adds
+    the new masks to in_dir's density table (pipeline.density).
+    '''
+    cache_path = os.path.join(in_dir, INDEX_FILE.format('_tier2' if tier2 else ''))
+    mtimes = _dir_mtimes(_source_dirs(in_dir, tier2))
+
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+            if cached.get('version') == INDEX_VERSION and cached.get('mtimes') == mtimes:
+                return cached['index']
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, AttributeError):
+            pass
+
+    index = build_tile_index(in_dir, tier2=tier2)
+    # Summed-area tables for density-steered crops, for masks new to this index.
+    update_density_table(list(index['mask']), in_dir)
+
+    if use_cache:
+        tmp_path = cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'version': INDEX_VERSION, 'mtimes': mtimes, 'index': index}, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print('Could not write tile index cache: {}'.format(e))
+
+    return index
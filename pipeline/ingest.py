@@ -8,6 +8,7 @@ import pandas as pd
 import rasterio
 import os.path
 import numpy as np
+from PIL import Image
 import rasterio.plot
 from rasterio.mask import raster_geometry_mask
 from rasterio.windows import Window, bounds
@@ -233,7 +234,13 @@ class Tile():
         self.scene_id = scene_id
         self.size=size
         self.window = Window(ypos, xpos, 1024,1024)
-        self.tile = self.scene.read(window=self.window)[:3]
+        bands = self.scene.read(window=self.window)
+        self.tile = bands[:3]
+        # Nodata pixels: alpha == 0 when the scene has an alpha band.
+        if len(bands) > 3:
+            self.nodata = bands[3] == 0
+        else:
+            self.nodata = np.zeros(bands.shape[1:], dtype=bool)
         self.alpha_pct = 1 - np.count_nonzero(self.tile[0]) / self.tile[0].size
         self.window_transform = rasterio.windows.transform(self.window, self.scene.transform)
         self.mask = None
@@ -271,6 +278,12 @@ class Tile():
         filename = self.scene_id+"_"+str(self.xpos)+"_"+str(self.ypos)
         image.save(os.path.join(path,'images', filename+"_i.jpg"))
         mask.save(os.path.join(path, 'masks', filename+'_mask.jpg'))
+        # Lossless 1-bit nodata mask, only for tiles that have nodata pixels.
+        if self.nodata.any():
+            os.makedirs(os.path.join(path, 'nodata'), exist_ok=True)
+            nodata = Image.frombytes(mode='1', size=self.nodata.shape[::-1],
+                                     data=np.packbits(self.nodata, axis=1))
+            nodata.save(os.path.join(path, 'nodata', filename+'_nodata.png'))
 
 
 
@@ -4,11 +4,19 @@ import glob
 import os
 import re
 import numpy as np
+import pandas as pd
 import pdb
 import torch
 import torchvision.transforms as transforms
-from torch.utils.data import Dataset, DataLoader
-from PIL import Image
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from PIL import Image, ImageOps
+
+from pipeline.autotune import PROFILE_FILE, load_loader_profile, loader_kwargs
+from pipeline.cache import TileCache
+from pipeline.density import DensityCropSampler, get_density_rows
+from pipeline.index import get_tile_index
+from pipeline.sampler import RegionBalancedSampler, SceneBlockSampler, ShardedSampler, StridedSampler
+from pipeline.stats import load_channel_stats, region_affine
 
 colorjitter = transforms.ColorJitter(brightness=0.25, contrast=0.25, saturation=0.25, hue=0.25)
 # ---- Image Utitilies ----
@@ -54,107 +62,129 @@ CITY_REGION_CTS = {
     'nia': {'_total': 65, '825a50': 65}
     }
 
-def is_valid_loc(basename, split):
+# ---- Region Tables ----
+
+# Cities used for training and for validation.
+CITY_SPLITS = {
+    'znz': 'train',
+    'acc': 'train',
+    'ptn': 'train',
+    'kam': 'train',
+    'mon': 'train',
+    'nia': 'train',
+    'dar': 'val',
+    }
+
+# One row per scene: which city it belongs to and which split it is used for.
+REGION_TABLE = pd.DataFrame(
+    [(scene, city, CITY_SPLITS[city])
+     for city, scenes in CITY_REGION_CTS.items()
+     for scene in scenes if scene != '_total'],
+    columns=['scene', 'city', 'split'])
+
+# Dataset split name -> region table splits it draws from.
+SPLIT_MEMBERS = {
+    'train': ['train'],
+    'test': ['val'],
+    'clean': ['train', 'val'],
+    }
+
+# Badly labeled rectangles to skip, in scene pixel coordinates. A tile at
+# (x, y) is excluded when x_0 - 512 <= x <= x_1 - 512 and likewise for y.
+SKIP_REGION_COLUMNS = ['scene', 'x_0', 'x_1', 'y_0', 'y_1', 'note']
+SKIP_REGIONS = pd.DataFrame([
+    ('d41d81', -1024, np.inf, -1024, np.inf, 'TEMPORARY EXCLUSION OF ENTIRE SCENE'),
+    ], columns=SKIP_REGION_COLUMNS)
+
+# Extra exclusion zones can be dropped into the data directory as a csv.
+SKIP_REGIONS_FILE = 'skip_regions.csv'
+
+
+def load_skip_regions(path):
     '''
-    Filter basenames according to allowed regions.
+    Read additional skip rectangles from a csv with SKIP_REGION_COLUMNS.
     '''
-    basename = os.path.basename(basename)
-    region, x_pos, y_pos, ext = basename.split('_')
+    skip_regions = pd.read_csv(path, dtype={'scene': str})
+    if 'note' not in skip_regions:
+        skip_regions['note'] = ''
+    return skip_regions[SKIP_REGION_COLUMNS].astype({'x_0': float, 'x_1': float, 'y_0': float, 'y_1': float})
 
-    train_regions = {
-        
-        # ZNZ - Zanzibar 
-        '076995': {'skip_region': []},
-        '75cdfa': {'skip_region': []},
-        '425403': {'skip_region': []},
-        '33cae6': {'skip_region': []},
-        '06f252': {'skip_region': []},
-        'e52478': {'skip_region': []},
-        'c7415c': {'skip_region': []},
-        'bc32f1': {'skip_region': []},
-        '3f8360': {'skip_region': []},
-        'aee7fd': {'skip_region': []},
-        '9b8638': {'skip_region': []},
-        'bd5c14': {'skip_region': []},
-        '3b20d4': {'skip_region': []},
-
-        # ACC - Accra
-        '665946': {'skip_region': []},
-        'a42435': {'skip_region': []},
-        'ca041a': {'skip_region': []},
-        'd41d81': {'skip_region': [
-            (-1024, np.inf , -1024, np.inf) # TEMPORARY EXCLUSION OF ENTIRE SCENE
-            ]},
-
-        # PTN
-        'abe1a3': {'skip_region': []},
-        'f49f31': {'skip_region': []},
-
-        # KAM
-        '4e7c7f': {'skip_region': []},
-
-        # MON
-        '401175': {'skip_region': []},
-        '493701': {'skip_region': []},
-        'f15272': {'skip_region': []},
-        '207cc7': {'skip_region': []},
-
-        # NIA
-        '825a50': {'skip_region': []},
 
-    }
+def split_scenes(split):
+    '''
+    Scenes that belong to a dataset split.
+    '''
+    members = SPLIT_MEMBERS.get(split, [])
+    return REGION_TABLE.loc[REGION_TABLE['split'].isin(members), 'scene'].values
 
 
-    
-    val_regions = {
-
-        # DAR
-        '353093': {'skip_region': []},
-        'f883a0': {'skip_region': []},
-        '0a4c40': {'skip_region': []},
-        '42f235': {'skip_region': []},
-        'a017f9': {'skip_region': []},
-        'b15fce': {'skip_region': []}
-        
-    }
+def excluded_tiles(index, skip_regions=SKIP_REGIONS):
+    '''
+    Boolean array, True where a tile lies inside a skip rectangle of its scene.
 
-    def is_excluded(x_0, x_1, y_0, y_1):
-        return (x_0 - 512 <= int(x_pos) <= x_1  - 512) and (y_0  - 512 <= int(y_pos) <= y_1 - 512)
-
-    if split == 'train' or split == 'clean': 
-        for reg, d in train_regions.items():
-            # Check all matching regions.
-            if reg == region:
-                # Skip regions that are badly labeled.
-                for x_0, x_1, y_0, y_1 in d['skip_region']:
-                    # print(x_0, x_1, y_0, y_1, "___", x_pos, y_pos)
-                    if is_excluded(x_0, x_1, y_0, y_1):
-                        return False
-                return True
-    
-    if split == 'test' or split == 'clean': 
-        for reg, d in val_regions.items():
-            # Check all matching regions.
-            if reg == region:
-                # Skip regions that are badly labeled.
-                for x_0, x_1, y_0, y_1 in d['skip_region']:
-                    # print(x_0, x_1, y_0, y_1, "___", x_pos, y_pos)
-                    if is_excluded(x_0, x_1, y_0, y_1):
-                        return False
-                return True
-                
-    return False
+    The rules are sorted by scene code, so the rules of every tile's scene are
+    a contiguous run found with searchsorted. Each (tile, rule) pair is then
+    tested against its rectangle in one vectorized comparison.
+    '''
+    excluded = np.zeros(len(index), dtype=bool)
+    if len(skip_regions) == 0 or len(index) == 0:
+        return excluded
+
+    scenes = index['scene'].astype('category')
+    codes = scenes.cat.codes.values
+    rule_codes = scenes.cat.categories.get_indexer(skip_regions['scene'].values)
+    matched = rule_codes >= 0
+    if not matched.any():
+        return excluded
+    order = np.argsort(rule_codes[matched], kind='stable')
+    rule_codes = rule_codes[matched][order]
+    bounds = skip_regions.loc[matched, ['x_0', 'x_1', 'y_0', 'y_1']].values[order] - 512
+
+    # Expand every tile into one pair per rule of its scene.
+    start = np.searchsorted(rule_codes, codes, side='left')
+    counts = np.searchsorted(rule_codes, codes, side='right') - start
+    rows = np.repeat(np.arange(len(index)), counts)
+    rules = np.arange(counts.sum()) + np.repeat(start - (np.cumsum(counts) - counts), counts)
+
+    x_pos, y_pos = index['x'].values[rows], index['y'].values[rows]
+    bounds = bounds[rules]
+    hit = ((bounds[:, 0] <= x_pos) & (x_pos <= bounds[:, 1]) &
+           (bounds[:, 2] <= y_pos) & (y_pos <= bounds[:, 3]))
+    excluded[rows[hit]] = True
+    return excluded
+
+
+def filter_index(index, split, skip_regions=SKIP_REGIONS):
+    '''
+    Keep the rows of a tile index that belong to split and are not skipped.
+    '''
+    keep = index['scene'].isin(split_scenes(split)).values
+    return index[keep & ~excluded_tiles(index, skip_regions)]
+
+
+def is_valid_loc(basename, split, skip_regions=SKIP_REGIONS):
+    '''
+    Filter basenames according to allowed regions.
+    '''
+    basename = os.path.basename(basename)
+    region, x_pos, y_pos, ext = basename.split('_')
+    tile = pd.DataFrame({'scene': [region], 'x': [int(x_pos)], 'y': [int(y_pos)]})
+    return len(filter_index(tile, split, skip_regions)) == 1
 
     
 
 
-def train_transform(image, mask):
+def train_transform(image, mask, crop_loc=None, jitter=True):
     '''
     Custom Pytorch randomized preprocessing of training image and mask.
+
+    crop_loc: optional (top, left) of the crop, random when not given.
+    jitter: apply color jitter (off for deterministic crops).
     '''
     image = transforms.functional.pad(image, padding=3, padding_mode='reflect')
     crop_size = 460
-    crop_loc = np.random.randint(0, 1024 - crop_size, 2)
+    if crop_loc is None:
+        crop_loc = np.random.randint(0, 1024 - crop_size, 2)
     image = transforms.functional.crop(image, *crop_loc, crop_size, crop_size)
     mask = transforms.functional.crop(mask, *crop_loc, crop_size, crop_size)
 
@@ -163,7 +193,8 @@ def train_transform(image, mask):
     #image = transforms.functional.rotate(image, rot_angle)
     #mask = transforms.functional.rotate(mask, rot_angle)
 
-    image = colorjitter(image)
+    if jitter:
+        image = colorjitter(image)
     # image = transforms.functional.pad(image, padding=3, fill=0, padding_mode='constant')
     image = transforms.functional.to_tensor(image)
     mask = transforms.functional.to_tensor(mask)
@@ -176,9 +207,84 @@ def val_transform(image, mask):
     mask = transforms.functional.to_tensor(mask)
     return image, mask
 
+def tile_transform(image, mask):
+    '''
+    Whole tile, uncropped, as used by the predict paths.
+    '''
+    return transforms.functional.to_tensor(image), transforms.functional.to_tensor(mask)
+
 def identity_transform(image, mask):
     return image, mask
 
+# ---- Nodata Masks ----
+
+# Label value of nodata pixels, ignored by the losses and IoU.
+IGNORE_LABEL = 255
+
+def add_nodata(mask, nodata):
+    '''
+    Attach a nodata mask as the alpha band of the label, so geometric
+    transforms move both together.
+    '''
+    valid = ImageOps.invert(nodata.convert('L'))
+    return Image.merge('LA', (mask.convert('L'), valid))
+
+
+def apply_nodata(mask):
+    '''
+    Collapse a transformed (2, H, W) label / valid tensor into a (1, H, W)
+    label with IGNORE_LABEL at nodata pixels.
+    '''
+    if not torch.is_tensor(mask) or mask.size(0) != 2:
+        return mask
+    label = mask[:1].clone()
+    label[mask[1:] < 0.5] = IGNORE_LABEL
+    return label
+
+# ---- Tile Selection ----
+
+def tile_cities(scenes):
+    '''
+    City of each scene id, falling back to the scene id for unknown scenes.
+    '''
+    scenes = pd.Series(np.asarray(scenes, dtype=str))
+    return scenes.map(REGION_TABLE.set_index('scene')['city']).fillna(scenes).values
+
+
+def select_tiles(in_dir, split=None, region=None, tier2=False):
+    '''
+    Tile index rows for a dataset: base tiles filtered by split and region,
+    followed by all tier 2 tiles when requested.
+    '''
+    index = get_tile_index(in_dir, tier2=tier2)
+    tiles = index[~index['tier2']]
+
+    if split =='clean' or split == 'train' or split == 'test':
+        skip_regions = SKIP_REGIONS
+        skip_path = os.path.join(in_dir, SKIP_REGIONS_FILE)
+        if os.path.exists(skip_path):
+            skip_regions = pd.concat([skip_regions, load_skip_regions(skip_path)], ignore_index=True)
+        tiles = filter_index(tiles, split, skip_regions)
+
+    if region is not None:
+        sample_ct = 100
+        tiles = tiles[tiles['key'].str.contains(region, regex=False)]
+        tiles = tiles.iloc[np.random.choice(len(tiles), size=sample_ct)]
+
+    if tier2:
+        tiles = pd.concat([tiles, index[index['tier2']]])
+    return tiles
+
+
+def split_tiles(tiles, val_frac=0.2, seed=100):
+    '''
+    Partition tile rows into (train, val), deterministically for a given seed.
+    '''
+    train_len = int(len(tiles) * (1 - val_frac))
+    perm = np.random.RandomState(seed).permutation(len(tiles))
+    return tiles.iloc[np.sort(perm[:train_len])], tiles.iloc[np.sort(perm[train_len:])]
+
+
 # ---- Dataset Class ----
 class DatasetWrapper(Dataset):
     def __init__(self, subset, transform=None):
@@ -197,13 +303,19 @@ class DatasetWrapper(Dataset):
 class MyDataset(Dataset):
     '''
     Custom PyTorch Dataset class.
+
+    tiles: optional tile index rows to use instead of scanning in_dir.
+    channel_stats: optional stats from compute_channel_stats; each image is
+        mapped from its city's channel mean / std onto the global ones.
     '''
-    def __init__(self, in_dir=None, custom_transforms=None, load_test=False, split=None, batch_trim=False, compressed=False, region=None, tier2=False):
+    def __init__(self, in_dir=None, custom_transforms=None, load_test=False, split=None, batch_trim=False, compressed=False, region=None, tier2=False, cache=None, crop_sampler=None, tiles=None, channel_stats=None):
 
         self.transforms = custom_transforms
         self.load_test = load_test
         self.compressed = compressed
         self.tier2 = tier2
+        self.cache = cache
+        self.crop_sampler = crop_sampler
 
         if in_dir is None:
             in_dir = 'training_data'
@@ -220,40 +332,14 @@ class MyDataset(Dataset):
 
         else:
             self.path = in_dir
-            pattern = os.path.join(self.path, 'images', '*.jpg')
-            self.images = glob.glob(pattern)
-
-            if split is None:
-                self.basenames = [os.path.basename(g) for g in self.images]
-
-            elif split =='clean' or split == 'train' or split == 'test':
-                self.basenames = [os.path.basename(g) for g in self.images if is_valid_loc(g, split)]
-            
-
-            if region is not None:
-                sample_ct = 100
-                self.basenames = [b for b in self.basenames if region in b]
-                self.basenames = np.random.choice(self.basenames, size=sample_ct)
-
-
-            self.images = []
-            self.masks = []
-            for basename in self.basenames:
-                img = os.path.join(self.path, 'images', basename)
-                mask = os.path.join(self.path, 'masks', basename.replace('_i.jpg', '_mask.jpg'))
-                if (os.path.exists(img) and os.path.exists(mask)):
-                    self.images.append(img)
-                    self.masks.append(mask)
-            if self.tier2:
-                pattern = os.path.join(self.path, 'tier2', 'images', '*.jpg')
-                images = glob.glob(pattern)
-                basenames = [os.path.basename(g) for g in images]
-                for basename in basenames:
-                    img= os.path.join(self.path, 'tier2', 'images', basename)
-                    mask = os.path.join(self.path, 'tier2', 'pseudolabels', basename)
-                    if (os.path.exists(img) and os.path.exists(mask)):
-                        self.images.append(img)
-                        self.masks.append(mask)
+            if tiles is None:
+                tiles = select_tiles(self.path, split=split, region=region, tier2=self.tier2)
+
+            self.basenames = [os.path.basename(p) for p in tiles['image']]
+            self.images = list(tiles['image'])
+            self.masks = list(tiles['mask'])
+            self.scenes = list(tiles['scene'])
+            self.nodata = list(tiles['nodata']) if 'nodata' in tiles else [None] * len(self.masks)
 
             self.coordinates = None
         
@@ -263,6 +349,13 @@ class MyDataset(Dataset):
                 pass
             else:
                 self.images, self.masks = self.images[:int(batch_trim)*16], self.masks[:int(batch_trim)*16]
+                if not self.load_test:
+                    self.scenes = self.scenes[:int(batch_trim)*16]
+                    self.nodata = self.nodata[:int(batch_trim)*16]
+
+        self.region_norm = None
+        if channel_stats is not None and not self.load_test:
+            self.region_norm = region_affine(channel_stats, tile_cities(self.scenes))
 
     def __getitem__(self, index):
         # print(index)
@@ -275,22 +368,149 @@ class MyDataset(Dataset):
             image_tensor = transforms.functional.to_tensor(image)[:3]
             return image_tensor, img_name
         else:
-            image = Image.open(self.images[index])
-            mask = Image.open(self.masks[index])
+            image = self._open(self.images[index])
+            mask = self._open(self.masks[index], kind='mask')
+            if isinstance(self.nodata[index], str):
+                mask = add_nodata(mask, self._open(self.nodata[index], kind='mask'))
             img_name = self.images[index]
-        if self.transforms is not None:
+        if self.transforms is not None and self.crop_sampler is not None:
+            image, mask = self.transforms(image, mask, crop_loc=self.crop_sampler.sample(index))
+        elif self.transforms is not None:
             image, mask = self.transforms(image, mask)
+        mask = apply_nodata(mask)
+        if self.region_norm is not None:
+            scale, shift = self.region_norm
+            image = image * torch.from_numpy(scale[index])[:, None, None] + torch.from_numpy(shift[index])[:, None, None]
         return (image, mask, img_name)
 
+    def _open(self, path, kind='image'):
+        '''
+        Open an image, going through the shared tile cache when one is set.
+
+        kind: 'image' or 'mask', the cache the decoded array is kept in.
+        '''
+        if self.cache is None:
+            return Image.open(path)
+        arr = self.cache.get(path, kind)
+        if arr is None:
+            image = Image.open(path)
+            if image.mode == '1':
+                image = image.convert('L')
+            arr = np.asarray(image)
+            self.cache.put(path, arr, kind)
+        return Image.fromarray(arr)
+
     def __len__(self):
         return len(self.images)
 
 
+class TileImageDataset(Dataset):
+    '''
+    Images only, as RGB tensors with their paths, for batch inference.
+    '''
+    def __init__(self, paths):
+        self.paths = list(paths)
+
+    def __getitem__(self, index):
+        image = Image.open(self.paths[index])
+        return transforms.functional.to_tensor(image)[:3], self.paths[index]
+
+    def __len__(self):
+        return len(self.paths)
+
+
 # ---- Load Dataset ----
 
-def get_dataloader(in_dir=None, load_test=False, batch_size=16, batch_trim=False, overwrite=False, out_dir=None, split=None, region=None, tier2=False):
+def get_region_sampler(dataset, level='city', epoch_len=None, alpha=0.0, seed=None, use_region_cts=False):
+    '''
+    Region-balanced sampler over a MyDataset, grouping tiles by city or by scene.
+
+    With use_region_cts, region weights come from CITY_REGION_CTS instead of
+    the tiles actually present in the dataset (only matters when alpha > 0).
+    '''
+    scenes = np.asarray(dataset.scenes, dtype=str)
+    if level == 'city':
+        groups = tile_cities(scenes)
+        counts = {city: d['_total'] for city, d in CITY_REGION_CTS.items()}
+    else:
+        groups = scenes
+        counts = {scene: ct for d in CITY_REGION_CTS.values() for scene, ct in d.items() if scene != '_total'}
+    if not use_region_cts:
+        counts = None
+    return RegionBalancedSampler(groups, num_samples=epoch_len, alpha=alpha, counts=counts, seed=seed)
+
+
+def add_density_crops(dataset, density_target):
+    '''
+    Attach a DensityCropSampler to a training MyDataset.
+    '''
+    table_path, rows = get_density_rows(dataset.masks, dataset.path)
+    dataset.crop_sampler = DensityCropSampler(table_path, rows, target=density_target)
+
+
+def make_loader(dataset, batch_size, sampler=None, epoch_len=None, profile=None, shard=None, seed=100):
+    '''
+    Shuffled DataLoader, or one drawing from a region-balanced or scene-block sampler.
+
+    Worker count, prefetch, persistence and pinning come from the loader profile.
+    shard: (rank, world_size) to load only this rank's share of every epoch;
+        the samplers are then seeded with seed so all ranks agree on the order.
+    '''
+    kwargs = loader_kwargs(profile)
+    if shard is not None:
+        rank, world_size = shard
+    if sampler == 'block':
+        block_sampler = SceneBlockSampler(
+            dataset.scenes, batch_size=batch_size, num_workers=kwargs['num_workers'],
+            seed=seed if shard is not None else None)
+        if shard is not None:
+            block_sampler = ShardedSampler(block_sampler, rank, world_size, chunk_size=batch_size)
+        return DataLoader(dataset, sampler=block_sampler, batch_size=batch_size, **kwargs)
+    if sampler is not None:
+        region_sampler = get_region_sampler(
+            dataset, level=sampler, epoch_len=epoch_len, seed=seed if shard is not None else None)
+        if shard is not None:
+            region_sampler = ShardedSampler(region_sampler, rank, world_size)
+        return DataLoader(
+                dataset, sampler=region_sampler, batch_size=batch_size, **kwargs
+                )
+    if shard is not None:
+        return DataLoader(
+                dataset, sampler=DistributedSampler(dataset, world_size, rank, shuffle=True, seed=seed),
+                batch_size=batch_size, **kwargs
+                )
+    return DataLoader(
+            dataset, shuffle=True, batch_size=batch_size, **kwargs
+            )
+
+
+def make_eval_loader(dataset, batch_size, profile=None, shard=None):
+    '''
+    Unshuffled DataLoader for validation; with shard, over this rank's
+    StridedSampler share, so every tile is scored exactly once across ranks.
+    '''
+    sampler = StridedSampler(len(dataset), *shard) if shard is not None else None
+    return DataLoader(dataset, shuffle=False, sampler=sampler, batch_size=batch_size,
+                      **loader_kwargs(profile))
+
+
+def get_dataloader(in_dir=None, load_test=False, batch_size=16, batch_trim=False, overwrite=False, out_dir=None, split=None, region=None, tier2=False, cache_gb=None, sampler=None, epoch_len=None, density_target=None, seed=100, profile_path=PROFILE_FILE, channel_stats=None, shard=None):
     '''
     Load pytorch batch data loader only
+
+    cache_gb: optional byte budget (GB) for a decoded tile cache shared across workers.
+    sampler: 'city' or 'scene' to draw region-balanced epochs of epoch_len tiles
+        instead of shuffling uniformly; 'block' to shuffle contiguous blocks of
+        each scene so each worker reads from a few small runs of files at a time.
+    density_target: building fraction that training crops are steered towards,
+        using per-tile summed-area tables of the masks.
+    seed: seed of the train / val partition for split='random'.
+    profile_path: loader profile written by autotune_loader, if present.
+    channel_stats: channel stats file; images are normalized per city onto
+        the global statistics.
+    shard: (rank, world_size) for distributed training; each rank loads a
+        disjoint, equally sized share of every epoch. Validation splits are
+        sharded without padding instead (make_eval_loader).
     '''
 
     def filter_written(name):
@@ -301,31 +521,52 @@ def get_dataloader(in_dir=None, load_test=False, batch_size=16, batch_trim=False
             return True
     
     print('Getting dataset.')
+    profile = load_loader_profile(profile_path)
+    if channel_stats is not None:
+        channel_stats = load_channel_stats(channel_stats)
     if split == 'train' or split == 'random' or split == 'clean':
         custom_transforms = train_transform
     elif split == 'test':
         custom_transforms = val_transform
     else:
         custom_transforms = val_transform
+    cache = None
+    if cache_gb and not load_test:
+        cache = TileCache(int(cache_gb * 1024**3))
+        print('Shared tile cache with {} slots.'.format(cache.num_slots))
+
+    if split == 'random':
+        # Partition the tile index first, so each side gets exactly one transform.
+        data_dir = in_dir if in_dir is not None else 'training_data'
+        tiles = select_tiles(data_dir, tier2=tier2)
+        train_tiles, val_tiles = split_tiles(tiles[~tiles['tier2']], val_frac=0.2, seed=seed)
+        train_tiles = pd.concat([train_tiles, tiles[tiles['tier2']]])
+
+        train_dataset = MyDataset(
+            in_dir=data_dir, custom_transforms=train_transform, batch_trim=batch_trim,
+            cache=cache, tiles=train_tiles, channel_stats=channel_stats
+            )
+        val_dataset = MyDataset(
+            in_dir=data_dir, custom_transforms=val_transform, batch_trim=batch_trim,
+            cache=cache, tiles=val_tiles, channel_stats=channel_stats
+            )
+        if density_target is not None:
+            add_density_crops(train_dataset, density_target)
+        train_loader = make_loader(train_dataset, batch_size, sampler=sampler, epoch_len=epoch_len, profile=profile,
+                                   shard=shard, seed=seed)
+        val_loader = make_eval_loader(val_dataset, batch_size, profile=profile, shard=shard)
+        return train_loader, val_loader
+
     dataset = MyDataset(
         in_dir=in_dir, custom_transforms=custom_transforms, region=region,
-        load_test=load_test, batch_trim=batch_trim, split=split, tier2=tier2
+        load_test=load_test, batch_trim=batch_trim, split=split, tier2=tier2,
+        cache=cache, channel_stats=channel_stats
         )
-    
-    # Check if images have been written.
-
-    if split=='random':
-        train_len = int(len(dataset)*0.8)
-        lengths = [train_len, len(dataset)-train_len]
-        train_subset, val_subset = torch.utils.data.random_split(dataset, lengths)
-        val_dataset = DatasetWrapper(val_subset, transform=val_transform)
-        train_dataset = DatasetWrapper(train_subset, transform=train_transform)
-        train_loader = DataLoader(train_dataset, shuffle=True, batch_size=batch_size, pin_memory=True,num_workers=3)
-        val_loader = DataLoader(val_dataset, shuffle=False, batch_size=batch_size, pin_memory=True, num_workers=3)
-        return train_loader, val_loader
-    else:
-        return DataLoader(
-                dataset, shuffle=True, batch_size=batch_size, pin_memory=True, num_workers=3
-                )
 
+    if density_target is not None and custom_transforms is train_transform and not load_test:
+        add_density_crops(dataset, density_target)
 
+    if shard is not None and custom_transforms is val_transform:
+        return make_eval_loader(dataset, batch_size, profile=profile, shard=shard)
+    return make_loader(dataset, batch_size, sampler=sampler, epoch_len=epoch_len, profile=profile,
+                       shard=shard, seed=seed)
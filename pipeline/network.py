@@ -5,10 +5,12 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from FastFCN import encoding
 from FastFCN.encoding import dilated as resnet
 from FastFCN.encoding.utils import batch_pix_accuracy, batch_intersection_union
+from pipeline.stats import load_channel_stats
 
 # ------------------------------------------
 # Network Modules
@@ -17,17 +19,50 @@ from FastFCN.encoding.utils import batch_pix_accuracy, batch_intersection_union
 
 # ----- Base Network ----- #
 UP_KWARGS = {'mode': 'bilinear', 'align_corners': True}
+CHECKPOINT_SEGMENTS = ['layer1', 'layer2', 'layer3', 'layer4', 'jpu']
+
+
+class _Recompute(object):
+    '''
+    Calls module; on the recomputation during backward, BatchNorm running
+    statistics are restored afterwards so they are only updated once per step.
+
+    The restore runs in a finally block: non-reentrant checkpointing may stop
+    the recomputation early by raising once the tensors it needs are rebuilt.
+    '''
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+
+    def __call__(self, *inputs):
+        self.calls += 1
+        if self.calls == 1:
+            return self.module(*inputs)
+        buffers = [(b, b.clone()) for m in self.module.modules()
+                   if isinstance(m, nn.modules.batchnorm._BatchNorm) for b in m.buffers()]
+        try:
+            return self.module(*inputs)
+        finally:
+            with torch.no_grad():
+                for b, saved in buffers:
+                    b.copy_(saved)
+
 
 class BaseNet(nn.Module):
     def __init__(self, nclass, backbone, aux, se_loss, jpu=True, dilated=False, norm_layer=None,
                  base_size=520, crop_size=480, mean=[.485, .456, .406],
-                 std=[.229, .224, .225], root='~/.encoding/models', **kwargs):
+                 std=[.229, .224, .225], root='~/.encoding/models', normalize=False,
+                 checkpoint_segments=None, checkpoint_blocks=False, **kwargs):
         super(BaseNet, self).__init__()
         self.nclass = nclass
         self.aux = aux
         self.se_loss = se_loss
         self.mean = mean
         self.std = std
+        # Input normalization, off by default: existing weights were trained on raw [0, 1] input.
+        self.normalize = normalize
+        self.register_buffer('input_mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('input_std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
         self.base_size = base_size
         self.crop_size = crop_size
         # copying modules from pretrained models
@@ -49,22 +84,56 @@ class BaseNet(nn.Module):
         self._up_kwargs = UP_KWARGS
         self.backbone = backbone
         self.jpu = JPU([512, 1024, 2048], width=512, norm_layer=norm_layer, up_kwargs=self._up_kwargs) if jpu else None
-
-    def base_forward(self, x):
+        self.set_checkpoint(checkpoint_segments, checkpoint_blocks)
+
+    def set_checkpoint(self, segments=None, blocks=False):
+        '''
+        Recompute activations of segments (names in CHECKPOINT_SEGMENTS) during
+        backward instead of storing them. With blocks=True every bottleneck of
+        a checkpointed layer is its own segment, so only block inputs are kept;
+        otherwise only the layer input is kept and the whole layer is rerun.
+        '''
+        unknown = set(segments or []) - set(CHECKPOINT_SEGMENTS)
+        if unknown:
+            raise RuntimeError('unknown checkpoint segments: {}'.format(sorted(unknown)))
+        self.checkpoint_segments = set(segments or [])
+        self.checkpoint_blocks = blocks
+
+    def _segment(self, name, module, *inputs):
+        if name not in self.checkpoint_segments or not torch.is_grad_enabled():
+            return module(*inputs)
+        if self.checkpoint_blocks and isinstance(module, nn.Sequential):
+            x, = inputs
+            for block in module:
+                x = checkpoint(_Recompute(block), x, use_reentrant=False)
+            return x
+        return checkpoint(_Recompute(module), *inputs, use_reentrant=False)
+
+    def backbone_forward(self, x):
+        '''
+        Backbone features c1..c4 of an image batch.
+        '''
+        if self.normalize:
+            x = (x - self.input_mean) / self.input_std
         x = self.pretrained.conv1(x)
         x = self.pretrained.bn1(x)
         x = self.pretrained.relu(x)
         x = self.pretrained.maxpool(x)
-        c1 = self.pretrained.layer1(x)
-        c2 = self.pretrained.layer2(c1)
-        c3 = self.pretrained.layer3(c2)
-        c4 = self.pretrained.layer4(c3)
+        c1 = self._segment('layer1', self.pretrained.layer1, x)
+        c2 = self._segment('layer2', self.pretrained.layer2, c1)
+        c3 = self._segment('layer3', self.pretrained.layer3, c2)
+        c4 = self._segment('layer4', self.pretrained.layer4, c3)
+        return c1, c2, c3, c4
 
+    def jpu_forward(self, c1, c2, c3, c4):
         if self.jpu:
-            return self.jpu(c1, c2, c3, c4)
+            return self._segment('jpu', self.jpu, c1, c2, c3, c4)
         else:
             return c1, c2, c3, c4
 
+    def base_forward(self, x):
+        return self.jpu_forward(*self.backbone_forward(x))
+
     def evaluate(self, x, target=None):
         pred = self.forward(x)
         if isinstance(pred, (tuple, list)):
@@ -87,15 +156,24 @@ class EncNet(BaseNet):
         if aux:
             self.auxlayer = FCNHead(1024, nclass, norm_layer=norm_layer)
 
-    def forward(self, x):
-        imsize = x.size()[2:]
-        features = self.base_forward(x)
-
+    def forward(self, x, upsample=True):
+        '''
+        upsample=False returns logits at head resolution (stride 8), for
+        losses computed against downsampled masks.
+        '''
+        return self.head_forward(self.base_forward(x), x.size()[2:], upsample=upsample)
+
+    def head_forward(self, features, imsize, upsample=True):
+        '''
+        Head outputs from base_forward features, for an input of size imsize.
+        '''
         x = list(self.head(*features))
-        x[0] = F.interpolate(x[0], imsize, **self._up_kwargs)
+        if upsample:
+            x[0] = F.interpolate(x[0], imsize, **self._up_kwargs)
         if self.aux:
             auxout = self.auxlayer(features[2])
-            auxout = F.interpolate(auxout, imsize, **self._up_kwargs)
+            if upsample:
+                auxout = F.interpolate(auxout, imsize, **self._up_kwargs)
             x.append(auxout)
         return tuple(x)
 
@@ -294,7 +372,16 @@ def get_model(args):
     else:
         num_class = 2
 
+    # Normalize input with measured dataset statistics when a stats file is given.
+    model_kwargs = {}
+    if getattr(args, 'channel_stats', None) is not None:
+        stats = load_channel_stats(args.channel_stats)['global']
+        model_kwargs = {'mean': stats['mean'], 'std': stats['std'], 'normalize': True}
+    # Activation checkpointing of backbone layers / JPU, if requested.
+    model_kwargs['checkpoint_segments'] = getattr(args, 'checkpoint', None)
+    model_kwargs['checkpoint_blocks'] = getattr(args, 'checkpoint_blocks', False)
+
     return EncNet(num_class, backbone=args.backbone, root='FastFCN/encoding/models',
                         dilated = args.dilated, lateral=args.lateral, jpu=args.jpu, aux=args.aux,
                         se_loss = args.se_loss, norm_layer = nn.BatchNorm2d,
-                        base_size = args.base_size, crop_size=args.crop_size)
+                        base_size = args.base_size, crop_size=args.crop_size, **model_kwargs)
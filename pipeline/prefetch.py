@@ -0,0 +1,155 @@
+
+import queue
+import threading
+import time
+import torch
+
+# ---- Device Prefetching ----
+
+def _to_device(batch, device, non_blocking=False, pin=False):
+    '''
+    Move every tensor in a (nested) batch to device, leaving other items alone.
+    '''
+    if torch.is_tensor(batch):
+        if pin and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_to_device(b, device, non_blocking, pin) for b in batch)
+    if isinstance(batch, dict):
+        return {k: _to_device(v, device, non_blocking, pin) for k, v in batch.items()}
+    return batch
+
+
+def _record_stream(batch, stream):
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            _record_stream(b, stream)
+    elif isinstance(batch, dict):
+        for b in batch.values():
+            _record_stream(b, stream)
+
+
+class DevicePrefetcher(object):
+    '''
+    Wrap a DataLoader so the next batch is already on device when it is asked for.
+
+    On CUDA the next batch is pinned (unless the loader already pins it) and
+    copied on a side stream while the current step runs. On CPU a background
+    thread keeps one batch ready ahead of the loop (double buffering).
+
+    The time the loop spends blocked on each batch is recorded; stats()
+    summarises it per epoch so input stalls show up next to the loss.
+    '''
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.waits = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __iter__(self):
+        self.waits = []
+        if self.cuda:
+            batches = self._cuda_iter()
+        else:
+            batches = self._thread_iter()
+
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.waits.append(time.perf_counter() - start)
+            yield batch
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(device=self.device)
+        pin = not getattr(self.loader, 'pin_memory', False)
+
+        def stage(batch):
+            with torch.cuda.stream(stream):
+                return _to_device(batch, self.device, non_blocking=True, pin=pin)
+
+        it = iter(self.loader)
+        try:
+            nxt = stage(next(it))
+        except StopIteration:
+            return
+        while nxt is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            batch = nxt
+            # The compute stream now owns these tensors' memory.
+            _record_stream(batch, torch.cuda.current_stream(self.device))
+            try:
+                nxt = stage(next(it))
+            except StopIteration:
+                nxt = None
+            yield batch
+
+    def _thread_iter(self):
+        done = object()
+        buf = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            # Give up once the consumer has stopped, instead of blocking on a full queue.
+            while not stop.is_set():
+                try:
+                    buf.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put(_to_device(batch, self.device)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = buf.get()
+                if batch is done:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # Unblock the worker if the loop stopped early (e.g. break).
+            stop.set()
+            thread.join()
+
+    def stats(self):
+        '''
+        Data wait time of the last pass: total, mean and max seconds per step.
+        '''
+        n = len(self.waits)
+        total = sum(self.waits)
+        return {
+            'steps': n,
+            'wait_total': total,
+            'wait_mean': total / n if n else 0.0,
+            'wait_max': max(self.waits) if n else 0.0,
+            }
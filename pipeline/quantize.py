@@ -0,0 +1,143 @@
+
+import copy
+import torch
+from tqdm import tqdm
+
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+except ImportError:
+    prepare_fx = None
+
+# ---- Post-Training Static Quantization ----
+
+# Submodules quantized to INT8, each traced on its own with FX. Everything
+# else stays in float: the stem's maxpool, EncModule (the Encoding layer's
+# soft assignment and the channel gating do not quantize well), conv6, which
+# produces the logits that get thresholded, and interpolation between stages.
+QUANT_MODULES = [
+    'pretrained.conv1',
+    'pretrained.layer1', 'pretrained.layer2', 'pretrained.layer3', 'pretrained.layer4',
+    'jpu.conv5', 'jpu.conv4', 'jpu.conv3',
+    'jpu.dilation1', 'jpu.dilation2', 'jpu.dilation3', 'jpu.dilation4',
+    'head.conv5',
+    'auxlayer',
+    ]
+
+# Only shapes matter for the example that FX traces with.
+EXAMPLE_SIZE = 256
+
+
+def _example_inputs(model, names, example):
+    '''
+    Inputs each named submodule sees when model runs on example.
+    '''
+    inputs, hooks = {}, []
+    for name in names:
+        def hook(module, args, name=name):
+            inputs[name] = tuple(a.detach() for a in args)
+        hooks.append(model.get_submodule(name).register_forward_pre_hook(hook))
+    try:
+        with torch.no_grad():
+            model(example)
+    finally:
+        for h in hooks:
+            h.remove()
+    return inputs
+
+
+def _set_submodule(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+
+def _has_submodule(model, name):
+    try:
+        model.get_submodule(name)
+        return True
+    except AttributeError:
+        return False
+
+
+def prepare_quantization(model, example, backend='x86', names=QUANT_MODULES):
+    '''
+    Eval-mode copy of model with observers inserted in the named submodules.
+
+    FX fuses conv + BN (+ ReLU) inside each submodule before observing, and
+    residual adds and concatenations get quantized versions. Submodules not
+    present in the model (e.g. auxlayer without aux) are skipped. Returns the
+    prepared model and the names actually prepared.
+    '''
+    if prepare_fx is None:
+        raise ImportError('INT8 quantization requires torch >= 1.13 (torch.ao.quantization).')
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    names = [n for n in names if _has_submodule(model, n)]
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    inputs = _example_inputs(model, names, example)
+    for name in names:
+        prepared = prepare_fx(model.get_submodule(name), qconfig_mapping, inputs[name])
+        _set_submodule(model, name, prepared)
+    return model, names
+
+
+def convert_quantization(model, names):
+    '''
+    Replace the observed submodules of a prepared model with INT8 ones, in place.
+    '''
+    for name in names:
+        _set_submodule(model, name, convert_fx(model.get_submodule(name)))
+    return model
+
+
+def calibrate(model, loader, num_tiles=256):
+    '''
+    Run about num_tiles tiles through a prepared model to record activation ranges.
+    '''
+    seen = 0
+    with torch.no_grad():
+        tbar = tqdm(loader, desc='calibrating')
+        for batch in tbar:
+            model(batch[0].cpu())
+            seen += len(batch[0])
+            if seen >= num_tiles:
+                break
+    return seen
+
+
+def quantize_model(model, loader, num_tiles=256, backend='x86', names=QUANT_MODULES):
+    '''
+    Static post-training INT8 quantization of model for CPU inference.
+
+    Observers are placed in every submodule of names, one calibration pass
+    over num_tiles tiles from loader records their ranges, then each
+    submodule is converted. Returns the quantized copy; model is unchanged.
+    '''
+    example = torch.rand(1, 3, EXAMPLE_SIZE, EXAMPLE_SIZE)
+    prepared, names = prepare_quantization(model, example, backend=backend, names=names)
+    seen = calibrate(prepared, loader, num_tiles=num_tiles)
+    print('Calibrated {} submodules on {} tiles.'.format(len(names), seen))
+    return convert_quantization(prepared, names)
+
+
+def is_quantized(model):
+    return any(type(m).__module__.startswith('torch.ao.nn.quantized') for m in model.modules())
+
+
+def save_quantized(model, path):
+    torch.save(model.state_dict(), path)
+    print('Saved quantized weights to {}'.format(path))
+
+
+def load_quantized(model, path, backend='x86', names=QUANT_MODULES):
+    '''
+    Rebuild the quantized structure around a float model and load INT8 weights.
+
+    The observers of the rebuilt model are never calibrated: scales and zero
+    points come from the saved state dict.
+    '''
+    example = torch.rand(1, 3, EXAMPLE_SIZE, EXAMPLE_SIZE)
+    prepared, names = prepare_quantization(model, example, backend=backend, names=names)
+    quantized = convert_quantization(prepared, names)
+    quantized.load_state_dict(torch.load(path, map_location='cpu'))
+    return quantized
@@ -0,0 +1,215 @@
+
+import numpy as np
+from torch.utils.data import Sampler
+
+# ---- Samplers ----
+
+class RegionBalancedSampler(Sampler):
+    '''
+    Draw fixed-length epochs with every region weighted equally.
+
+    groups holds one region label per dataset item (a city or a scene id).
+    Each draw picks a region with probability proportional to count**alpha,
+    then a tile uniformly within it: alpha=0 balances regions, alpha=1 is
+    plain uniform sampling over tiles. Counts default to the number of items
+    per region but can be given explicitly, e.g. from CITY_REGION_CTS.
+
+    Indices are generated in chunks while iterating, so an epoch never
+    materializes a list of num_samples indices.
+    '''
+    def __init__(self, groups, num_samples=None, alpha=0.0, counts=None, seed=None, chunk_size=4096):
+        groups = np.asarray(groups)
+        labels, inverse = np.unique(groups, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+
+        # CSR layout: items of region g are order[starts[g]:starts[g] + sizes[g]].
+        self.labels = labels
+        self.order = order
+        self.sizes = np.bincount(inverse, minlength=len(labels))
+        self.starts = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+
+        if counts is None:
+            weights = self.sizes.astype(np.float64)
+        else:
+            weights = np.array([counts.get(label, 0) for label in labels], dtype=np.float64)
+        weights = weights ** alpha
+        weights[self.sizes == 0] = 0
+        self.probs = weights / weights.sum()
+
+        self.num_samples = int(num_samples) if num_samples else len(groups)
+        self.seed = seed
+        self.epoch = 0
+        self.chunk_size = chunk_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def region_probs(self):
+        '''
+        Probability of drawing each region, keyed by label.
+        '''
+        return dict(zip(self.labels.tolist(), self.probs.tolist()))
+
+    def __iter__(self):
+        seed = None if self.seed is None else self.seed + self.epoch
+        rng = np.random.default_rng(seed)
+        remaining = self.num_samples
+        while remaining > 0:
+            n = min(self.chunk_size, remaining)
+            regions = rng.choice(len(self.labels), size=n, p=self.probs)
+            offsets = (rng.random(n) * self.sizes[regions]).astype(np.int64)
+            yield from self.order[self.starts[regions] + offsets].tolist()
+            remaining -= n
+
+    def __len__(self):
+        return self.num_samples
+
+
+class SceneBlockSampler(Sampler):
+    '''
+    Shuffle at block level so reads stay local to a scene.
+
+    Tiles of each scene (in dataset order, i.e. file order) are cut into
+    contiguous blocks of block_size, with a random phase every epoch so block
+    boundaries move. Blocks are shuffled and dealt out to the DataLoader
+    workers; each worker's tiles are shuffled together within a window of
+    buffer_blocks blocks. Batches are emitted round-robin in the order the
+    DataLoader hands them to workers, so every worker only reads from
+    buffer_blocks contiguous runs of a few scenes at a time (in random order
+    inside the window), while each batch still mixes buffer_blocks blocks.
+
+    batch_size and num_workers must match the DataLoader for the worker
+    assignment to line up; with other values the order is still valid, just
+    less local.
+    '''
+    def __init__(self, groups, block_size=64, buffer_blocks=4, batch_size=1, num_workers=0, seed=None):
+        groups = np.asarray(groups)
+        labels, inverse = np.unique(groups, return_inverse=True)
+        self.order = np.argsort(inverse, kind='stable')
+        self.sizes = np.bincount(inverse, minlength=len(labels))
+        self.starts = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+
+        self.block_size = int(block_size)
+        self.buffer_blocks = int(buffer_blocks)
+        self.batch_size = int(batch_size)
+        self.num_workers = max(1, int(num_workers))
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def blocks(self, rng):
+        '''
+        Contiguous blocks of dataset indices, each from a single group.
+        '''
+        blocks = []
+        for start, size in zip(self.starts, self.sizes):
+            items = self.order[start:start + size]
+            phase = int(rng.integers(self.block_size)) if size > self.block_size else 0
+            cuts = np.arange(phase, size, self.block_size)[1 if phase == 0 else 0:]
+            blocks.extend(b for b in np.split(items, cuts) if len(b))
+        return blocks
+
+    def worker_streams(self, rng):
+        '''
+        Per-worker index arrays: dealt blocks, shuffled within each window.
+        '''
+        blocks = self.blocks(rng)
+        assigned = [[] for _ in range(self.num_workers)]
+        loads = np.zeros(self.num_workers, dtype=np.int64)
+        for i in rng.permutation(len(blocks)):
+            w = int(np.argmin(loads))
+            assigned[w].append(blocks[i])
+            loads[w] += len(blocks[i])
+
+        streams = []
+        for worker_blocks in assigned:
+            windows = [
+                rng.permutation(np.concatenate(worker_blocks[i:i + self.buffer_blocks]))
+                for i in range(0, len(worker_blocks), self.buffer_blocks)
+                ]
+            streams.append(np.concatenate(windows) if windows else np.zeros(0, dtype=np.int64))
+        return streams
+
+    def __iter__(self):
+        seed = None if self.seed is None else self.seed + self.epoch
+        rng = np.random.default_rng(seed)
+        streams = self.worker_streams(rng)
+        pos = [0] * len(streams)
+        remaining = len(self)
+        k = 0
+        while remaining > 0:
+            need = min(self.batch_size, remaining)
+            # The batch goes to worker k % num_workers; top it up from the
+            # other streams once that worker's blocks run out.
+            first = k % self.num_workers
+            for w in [first] + [w for w in range(len(streams)) if w != first]:
+                take = streams[w][pos[w]:pos[w] + need]
+                pos[w] += len(take)
+                need -= len(take)
+                remaining -= len(take)
+                yield from take.tolist()
+                if need == 0:
+                    break
+            k += 1
+
+    def __len__(self):
+        return int(self.sizes.sum())
+
+
+class ShardedSampler(Sampler):
+    '''
+    One rank's share of another sampler's indices, for distributed training.
+
+    The base stream is cut into chunks of chunk_size indices (e.g. one batch
+    of a SceneBlockSampler, to keep its blocks together) and chunk i goes to
+    rank i % world_size. Every rank must draw the same base stream, so the
+    base sampler needs a fixed seed; set_epoch is passed through. The stream
+    is trimmed so all ranks get the same number of chunks, and therefore run
+    the same number of steps.
+    '''
+    def __init__(self, sampler, rank, world_size, chunk_size=1):
+        self.sampler = sampler
+        self.rank = rank
+        self.world_size = world_size
+        self.chunk_size = chunk_size
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def _chunks_per_rank(self):
+        return len(self.sampler) // (self.chunk_size * self.world_size)
+
+    def __iter__(self):
+        total = self._chunks_per_rank() * self.world_size
+        for pos, index in enumerate(self.sampler):
+            chunk = pos // self.chunk_size
+            if chunk >= total:
+                break
+            if chunk % self.world_size == self.rank:
+                yield index
+
+    def __len__(self):
+        return self._chunks_per_rank() * self.chunk_size
+
+
+class StridedSampler(Sampler):
+    '''
+    Every world_size-th index of a dataset from rank, in order, for evaluation.
+
+    Unlike DistributedSampler nothing is padded or repeated: the shards are
+    disjoint and together cover the dataset exactly once, so sums over
+    ranks count every tile once. Shards may differ in length by one.
+    '''
+    def __init__(self, num_samples, rank, world_size):
+        self.num_samples = num_samples
+        self.rank = rank
+        self.world_size = world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_samples, self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_samples, self.world_size))
@@ -71,6 +71,10 @@ def scan_scenes(path):
                 upload_blob(bucketname, os.path.join(path, 'masks', filename+'_mask.jpg'))
                 remove(os.path.join(path, 'images', filename+'_i.jpg'))
                 remove(os.path.join(path, 'masks', filename+'_mask.jpg'))
+                nodata_path = os.path.join(path, 'nodata', filename+'_nodata.png')
+                if os.path.exists(nodata_path):
+                    upload_blob(bucketname, nodata_path)
+                    remove(nodata_path)
 
         image.scene.close()
 
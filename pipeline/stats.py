@@ -0,0 +1,165 @@
+
+import json
+import multiprocessing as mp
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# ---- Channel Statistics ----
+
+STATS_FILE = 'channel_stats.json'
+BINS = 256
+
+
+class ChannelStats(object):
+    '''
+    Mergeable per-channel count, mean, M2 and histogram of uint8 pixels.
+
+    Each update folds a whole tile in with the pairwise (Chan et al.) form of
+    Welford's algorithm, so partial results from different workers or regions
+    merge exactly. Means and variances are reported on the [0, 1] scale that
+    to_tensor produces.
+    '''
+    def __init__(self, channels=3):
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+        self.hist = np.zeros((channels, BINS), dtype=np.int64)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    def update(self, pixels):
+        '''
+        Add an (H, W, C) or (N, C) uint8 array of pixels.
+        '''
+        pixels = np.asarray(pixels).reshape(-1, len(self.mean))
+        if len(pixels) == 0:
+            return
+        values = pixels.astype(np.float64) / 255.
+        mean = values.mean(0)
+        self._combine(len(values), mean, ((values - mean) ** 2).sum(0))
+        for c in range(len(self.mean)):
+            self.hist[c] += np.bincount(pixels[:, c], minlength=BINS)
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2)
+        self.hist += other.hist
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def to_dict(self):
+        return {
+            'count': int(self.count),
+            'mean': self.mean.tolist(),
+            'var': self.var.tolist(),
+            'std': self.std.tolist(),
+            'm2': self.m2.tolist(),
+            'hist': self.hist.tolist(),
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(len(d['mean']))
+        stats.count = d['count']
+        stats.mean = np.array(d['mean'])
+        stats.m2 = np.array(d['m2'])
+        stats.hist = np.array(d['hist'], dtype=np.int64)
+        return stats
+
+
+def _chunk_stats(chunk):
+    '''
+    Worker: accumulate stats for a list of (group, image path, nodata path) triples.
+
+    Pixels marked in the tile's nodata mask (nonzero), if it has one, are left out.
+    '''
+    stats = {}
+    for group, path, nodata in chunk:
+        pixels = np.asarray(Image.open(path).convert('RGB'))
+        if isinstance(nodata, str):
+            pixels = pixels[np.asarray(Image.open(nodata).convert('L')) == 0]
+        stats.setdefault(group, ChannelStats()).update(pixels)
+    return stats
+
+
+def compute_channel_stats(paths, groups, tiles_per_group=200, num_workers=4, seed=0, chunk_size=16, out_path=STATS_FILE, nodata=None):
+    '''
+    Per-group and global channel statistics from a sample of tiles.
+
+    nodata: optional nodata mask path (or None) per tile, from the tile index;
+        nodata pixels do not count towards the statistics.
+
+    Up to tiles_per_group tiles are drawn from each group (e.g. each city)
+    and decoded once, in parallel. Group results merge into the global
+    entry, so the global mean and variance are exact for the sampled pixels.
+    '''
+    paths, groups = np.asarray(paths), np.asarray(groups)
+    if nodata is None:
+        nodata = [None] * len(paths)
+    nodata = np.asarray(nodata, dtype=object)
+    rng = np.random.RandomState(seed)
+    sample = []
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        if tiles_per_group and len(members) > tiles_per_group:
+            members = rng.choice(members, tiles_per_group, replace=False)
+        sample.extend((str(group), paths[i], nodata[i]) for i in members)
+    chunks = [sample[i:i + chunk_size] for i in range(0, len(sample), chunk_size)]
+
+    regions = {}
+    with mp.Pool(max(1, num_workers)) as pool:
+        for part in tqdm(pool.imap_unordered(_chunk_stats, chunks), total=len(chunks), desc='channel stats'):
+            for group, stats in part.items():
+                regions.setdefault(group, ChannelStats()).merge(stats)
+
+    total = ChannelStats()
+    for stats in regions.values():
+        total.merge(stats)
+
+    result = {
+        'tiles_per_group': tiles_per_group,
+        'tiles': len(sample),
+        'global': total.to_dict(),
+        'regions': {group: stats.to_dict() for group, stats in sorted(regions.items())},
+        }
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(result, f)
+        print('Saved channel stats to {}'.format(out_path))
+    return result
+
+
+def load_channel_stats(path=STATS_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def region_affine(stats, regions):
+    '''
+    Per-item (scale, shift) mapping each region's mean / std onto the global ones.
+
+    Items of regions missing from the stats file get the identity.
+    '''
+    g_mean, g_std = np.array(stats['global']['mean']), np.array(stats['global']['std'])
+    scale = np.ones((len(regions), len(g_mean)), dtype=np.float32)
+    shift = np.zeros((len(regions), len(g_mean)), dtype=np.float32)
+    for region, d in stats['regions'].items():
+        rows = np.asarray(regions) == region
+        r_scale = g_std / np.maximum(np.array(d['std']), 1e-6)
+        scale[rows] = r_scale
+        shift[rows] = g_mean - np.array(d['mean']) * r_scale
+    return scale, shift
@@ -7,11 +7,22 @@
 '''
 
 import argparse
+import functools
 import os
+import resource
+import time
 import numpy as np
 import torch
 import pipeline.criterion as Criterion
-from pipeline.load import get_dataloader
+from pipeline.load import get_dataloader, MyDataset, select_tiles, tile_cities, train_transform, IGNORE_LABEL
+from pipeline.stats import compute_channel_stats, STATS_FILE
+from pipeline.autotune import autotune_loader, load_loader_profile, PROFILE_FILE
+from pipeline.prefetch import DevicePrefetcher
+from pipeline.amp import amp_dtype, autocast, grad_scaler, to_float
+from pipeline.features import build_feature_cache, get_feature_loader, backbone_frozen
+from pipeline.distributed import (launch, is_distributed, is_main_process, get_rank, get_world_size,
+                                  get_local_world_size, main_process_first, local_device, prepare_model,
+                                  wrap_model, all_reduce_sum, broadcast_flag, INIT_FILE)
 import pipeline.network as Network
 from datetime import datetime, timedelta
 import FastFCN
@@ -36,8 +47,10 @@ def layer_gen(model):
 
 def save_model(model, experiment_name=None):
     '''
-    Save a model to the correct dictionary
+    Save a model to the correct dictionary; only rank 0 writes when distributed.
     '''
+    if not is_main_process():
+        return None
 
     model_dir = os.path.join('models', experiment_name)
     if not os.path.exists(model_dir):
@@ -49,6 +62,15 @@ def save_model(model, experiment_name=None):
     return None
 
 
+def peak_memory_mb(device):
+    '''
+    Peak memory since the last reset on CUDA; peak process RSS on CPU.
+    '''
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
     def __init__(self, patience=7, verbose=False, delta=0):
@@ -81,7 +103,8 @@ class EarlyStopping:
             self.save_checkpoint(val_loss, model, experiment_name)
         elif score < self.best_score + self.delta:
             self.counter += 1
-            print('Validaton Loss={}, best score = {}. \nEarlyStopping counter: {} out of {}'.format(score, self.best_score, self.counter, self.patience))
+            if is_main_process():
+                print('Validaton Loss={}, best score = {}. \nEarlyStopping counter: {} out of {}'.format(score, self.best_score, self.counter, self.patience))
             if self.counter >= self.patience:
                 self.early_stop = True
         else:
@@ -91,7 +114,7 @@ class EarlyStopping:
 
     def save_checkpoint(self, val_loss, model, experiment_name):
         '''Saves model when validation loss decrease.'''
-        if self.verbose:
+        if self.verbose and is_main_process():
             print('Validation loss decreased ({} --> {}).  Saving model ...'.format(self.val_loss_min, val_loss))
         save_model(model, experiment_name=experiment_name + '_chkpt')
         self.val_loss_min = val_loss
@@ -99,10 +122,23 @@ class EarlyStopping:
 
 def train_fastfcn_mod(
     options=None, num_epochs=1, reporting_int=5, batch_size=8,
-    experiment_name=None, train_path=None, batch_trim=None, tier2=None
+    experiment_name=None, train_path=None, batch_trim=None, tier2=None, cache_gb=None,
+    sampler=None, epoch_len=None, density_target=None, channel_stats=None, lovasz_bins=None,
+    boundary_weight=None, amp=None, checkpoint=None, checkpoint_blocks=False,
+    head_epochs=0, feature_cache=False
     ):
     '''
     Compile and train the modified FastFCN implementation.
+
+    amp: 'bf16' or 'fp16' to run forward passes under autocast (bf16 only on CPU).
+    checkpoint: backbone layers / 'jpu' whose activations are recomputed in
+        backward, per layer or, with checkpoint_blocks, per bottleneck.
+    head_epochs: epochs to train with the backbone frozen before layer_gen
+        starts unfreezing it. With feature_cache, these epochs train the JPU
+        and head from backbone features cached once on disk.
+
+    Run through distributed.launch, every process trains a DDP replica on its
+    shard of each epoch, with BatchNorm statistics synchronized across ranks.
     '''
 
     torch.cuda.empty_cache()
@@ -168,25 +204,59 @@ def train_fastfcn_mod(
         }
 
     options['cuda'] = torch.cuda.is_available() and not options['no_cuda']
+    options.setdefault('channel_stats', channel_stats)
+    options.setdefault('checkpoint', checkpoint)
+    options.setdefault('checkpoint_blocks', checkpoint_blocks)
 
     # Convert options dict to attributed object
     model_args = ObjectView(options)
+
+    shard = (get_rank(), get_world_size()) if is_distributed() else None
+    if shard is not None and feature_cache:
+        raise RuntimeError('feature_cache is not supported with distributed training.')
+    if shard is not None and cache_gb:
+        # cache_gb is the node's budget; every rank has its own tile cache.
+        cache_gb = cache_gb / get_local_world_size()
     
-    train_dataloader = get_dataloader(
-            in_dir=train_path, load_test=False, batch_size=batch_size, batch_trim=batch_trim, split='train', 
-            tier2=tier2
-        )
+    # Rank 0 builds the tile index and density tables, the other ranks then read them.
+    with main_process_first():
+        train_dataloader = get_dataloader(
+                in_dir=train_path, load_test=False, batch_size=batch_size, batch_trim=batch_trim, split='train', 
+                tier2=tier2, cache_gb=cache_gb, sampler=sampler, epoch_len=epoch_len,
+                density_target=density_target, channel_stats=channel_stats, shard=shard
+            )
+    tile_cache = getattr(train_dataloader.dataset, 'cache', None)
 
     if model_args.validation:
-        val_dataloader = get_dataloader(
-                in_dir=train_path, load_test=False, batch_size=16, batch_trim=batch_trim, split='test'
-        )
+        with main_process_first():
+            val_dataloader = get_dataloader(
+                    in_dir=train_path, load_test=False, batch_size=16, batch_trim=batch_trim, split='test',
+                    channel_stats=channel_stats, shard=shard
+            )
 
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    device = local_device()
     # Compile modified FastFCN model.
     model = Network.get_model(model_args)
     model.load_state_dict(torch.load('models/14-03-2020_10-49__unfreezing_layers_gen_chkpt/14-03-2020_10-49__unfreezing_layers_gen_chkpt_m.pt'))
+    model = prepare_model(model)
     model.to(device)
+    # Training forwards go through net (the DDP replica); validation and saving use model.
+    net = wrap_model(model, device)
+    train_batches = DevicePrefetcher(train_dataloader, device)
+    dtype = amp_dtype(amp, device)
+    scaler = grad_scaler(dtype)
+    feature_batches = None
+    if feature_cache and head_epochs:
+        cache_path = build_feature_cache(
+            model, in_dir=train_path, tier2=tier2, channel_stats=channel_stats, batch_size=batch_size,
+            batch_trim=batch_trim, density_target=density_target
+            )
+        feature_loader = get_feature_loader(cache_path, batch_size=batch_size, sampler=sampler, epoch_len=epoch_len)
+        # lr_scheduler counts len(train_dataloader) steps per epoch, cached or not.
+        if len(feature_loader) != len(train_dataloader):
+            raise RuntimeError('Feature cache loader has {} batches per epoch, the training loader {}.'.format(
+                len(feature_loader), len(train_dataloader)))
+        feature_batches = DevicePrefetcher(feature_loader, device)
     # Optimizer
     params = [p for p in model.parameters() if p.requires_grad]
     
@@ -206,15 +276,23 @@ def train_fastfcn_mod(
             model_args.epochs, len(train_dataloader))
 
 
-    if model_args.use_lovasz:
-        # Loss Function (Lovasz Hinge)
-        criterion = L.lovasz_hinge
+    head_loss = model_args.use_lovasz and boundary_weight is not None
+    if head_loss:
+        # Lovasz Hinge at head resolution against area-pooled masks
+        criterion = Criterion.HeadResolutionLoss(
+            ignore=IGNORE_LABEL, bins=lovasz_bins, boundary_weight=boundary_weight
+            )
+
+    elif model_args.use_lovasz:
+        # Loss Function (Lovasz Hinge), optionally the O(P) histogram approximation
+        criterion = functools.partial(L.lovasz_hinge, bins=lovasz_bins)
 
     else:
         # Loss Function (Segmentation Loss)
         criterion = Criterion.SegmentationLosses(
             se_loss=model_args.se_loss, aux=model_args.aux, nclass=2,
-            se_weight=model_args.se_weight, aux_weight=model_args.aux_weight
+            se_weight=model_args.se_weight, aux_weight=model_args.aux_weight,
+            ignore_index=IGNORE_LABEL
             )
 
     if model_args.early_stopping:
@@ -226,13 +304,14 @@ def train_fastfcn_mod(
     best_pred = 0.0
     for epoch in range(num_epochs):  # loop over the dataset multiple times
 
-        if epoch>0:
+        if epoch>0 and epoch>=head_epochs:
             try:
                 unfreeze_layer = next(bottom_up_layers)
                 unfreeze_layer.requires_grad_()
                 grp = {'params': unfreeze_layer.parameters()}
                 optimizer.add_param_group(grp)
-            except:
+                net = wrap_model(model, device)
+            except StopIteration:
                 pass    
 
         if model_args.early_stopping:
@@ -240,15 +319,28 @@ def train_fastfcn_mod(
                 break
 
         train_loss = 0.0
+        report_steps = 0
         model.train()
+        if hasattr(train_dataloader.sampler, 'set_epoch'):
+            train_dataloader.sampler.set_epoch(epoch)
+        epoch_start = time.perf_counter()
+        epoch_tiles = 0
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
         
-        for i, (images, masks, _) in enumerate(train_dataloader, 0):
+        # Cached features are only valid while the whole backbone is frozen.
+        cached = feature_batches is not None and backbone_frozen(model)
+        batches = feature_batches if cached else train_batches
+        if cached:
+            print('Training JPU and head from cached features.')
+
+        # Batches arrive already on device (copied while the previous step ran).
+        for i, batch in enumerate(batches, 0):
             
             # Set learning rate first time
             lr_scheduler(optimizer, i, epoch, best_pred)
 
-            images = images.to(device)
-            masks = masks.to(device).squeeze(1).round().long()
+            masks = batch[-2].squeeze(1).round().long()
 
             # get the inputs; data is a list of [inputs, labels]
             masks.requires_grad = False
@@ -256,24 +348,58 @@ def train_fastfcn_mod(
             # zero the parameter gradients
             optimizer.zero_grad()
 
-            # forward + backward + optimize
-            outputs = model(images)
-
-            if model_args.use_lovasz:
+            # forward + backward + optimize; losses always run in fp32
+            with autocast(device, dtype):
+                if cached:
+                    c2, c3, c4 = (f.float() for f in batch[:3])
+                    features = model.jpu_forward(None, c2, c3, c4)
+                    outputs = model.head_forward(features, masks.shape[-2:], upsample=not head_loss)
+                else:
+                    outputs = net(batch[0], upsample=not head_loss)
+            outputs = to_float(outputs)
+
+            if head_loss:
                 loss = criterion(outputs[0], masks)
+            elif model_args.use_lovasz:
+                loss = criterion(outputs[0], masks, ignore=IGNORE_LABEL)
             else:
                 loss = criterion(*outputs, masks)
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             # print statistics
             train_loss += loss.item()
+            report_steps += 1
+            epoch_tiles += masks.size(0)
 
             if i % reporting_int == 0:    # print every 2000 mini-batches
-                print('[%d, %5d] loss/batch: %.3f' %
-                    (epoch + 1, i + 1, train_loss / reporting_int))
+                # Mean loss over all ranks' steps since the last report; every rank joins the sum.
+                train_loss, report_steps = all_reduce_sum([train_loss, report_steps], device)
+                if is_main_process():
+                    print('[%d, %5d] loss/batch: %.3f' %
+                        (epoch + 1, i + 1, train_loss / report_steps))
                 train_loss = 0.0
+                report_steps = 0
+
+        wait_stats = batches.stats()
+        epoch_time = time.perf_counter() - epoch_start
+        # Tiles trained on by all ranks together.
+        epoch_tiles, = all_reduce_sum([epoch_tiles], device)
+        if is_main_process():
+            print('Data wait: {:.1f}s of {:.1f}s ({:.1%}), mean {:.3f}s, max {:.3f}s per step'.format(
+                wait_stats['wait_total'], epoch_time, wait_stats['wait_total'] / max(epoch_time, 1e-9),
+                wait_stats['wait_mean'], wait_stats['wait_max']))
+            print('Throughput: {:.1f} tiles/s, peak memory {:.0f} MB'.format(
+                epoch_tiles / max(epoch_time, 1e-9), peak_memory_mb(device)))
+
+        if tile_cache is not None and is_main_process():
+            cache_stats = tile_cache.stats()
+            print('Tile cache: {} hits, {} misses, hit rate {:.1%} ({} of {} slots used)'.format(
+                cache_stats['hits'], cache_stats['misses'], cache_stats['hit_rate'],
+                cache_stats['slots_used'], cache_stats['num_slots']))
+            tile_cache.reset_stats()
     
         #lr_scheduler.step()
 
@@ -282,7 +408,8 @@ def train_fastfcn_mod(
         # torch.cuda.empty_cache() # Necessary?!?
         
         if model_args.validation:
-            print('Calculating Validation Loss')
+            if is_main_process():
+                print('Calculating Validation Loss')
             with torch.no_grad():
                 model.eval()
                 val_loss = 0
@@ -293,14 +420,16 @@ def train_fastfcn_mod(
                     if model_args.use_jaccard:
                         images = images.to(device)
                         images.requires_grad=False
-                        outputs = model(images)
+                        with autocast(device, dtype):
+                            outputs = model(images)
 
-                        outputs = (outputs[0]>0).long().data
+                        outputs = (to_float(outputs)[0]>0).long().data
                         masks = masks.to(device)
 
-                        loss = L.iou_binary(outputs, masks)
+                        # Mean over the batch's images; weighted back to a per-image sum below.
+                        loss = L.iou_binary(outputs, masks, ignore=IGNORE_LABEL, per_image=True)
                         assert type(loss) == float
-                        val_loss += loss
+                        val_loss += loss * masks.size(0)
                         
                     else:
                         images = images.to(device)
@@ -310,15 +439,20 @@ def train_fastfcn_mod(
                         images.requires_grad=False
                         masks.requires_grad=False
 
-                        outputs = model(images)
-                        loss = criterion(*outputs, masks)
+                        with autocast(device, dtype):
+                            outputs = model(images)
+                        loss = criterion(*to_float(outputs), masks)
                         
-                        val_loss += loss.item()
+                        val_loss += loss.item() * masks.size(0)
 
-                    val_len = i
+                    val_len += masks.size(0)
 
                 # --- end of data iteration -------
-                print("Mean val loss per batch:", val_loss / val_len)
+                # Each rank scored its own unpadded shard; sum images over ranks before averaging.
+                val_loss, val_len = all_reduce_sum([val_loss, val_len], device)
+                val_loss = val_loss / max(val_len, 1)
+                if is_main_process():
+                    print("Mean val loss per image:", val_loss)
                 
                 if best_pred == 0:
                     best_pred = val_loss
@@ -328,14 +462,18 @@ def train_fastfcn_mod(
             if model_args.early_stopping:
                 # Check for early stopping conditions:
                 early_stopper(val_loss, model, experiment_name, use_lovasz=model_args.use_lovasz)
+                # Ranks stop together, on rank 0's decision.
+                early_stopper.early_stop = broadcast_flag(early_stopper.early_stop, device)
 
         # --- Save model if not using early stopping ----
         if not model_args.early_stopping:
             
             save_model(model, experiment_name=experiment_name + '_chkpt')
-            print('Checkpoint saved at epoch,', epoch+1)
+            if is_main_process():
+                print('Checkpoint saved at epoch,', epoch+1)
 
-        print('Epoch,', epoch+1, 'ended.')
+        if is_main_process():
+            print('Epoch,', epoch+1, 'ended.')
         # --- end of epoch -------
 
     save_model(model, experiment_name)
@@ -363,7 +501,10 @@ if __name__=='__main__':
         help='Number of batches between loss reports (int).')
     TRAIN_PARSER.add_argument(
         '-batch_size', default=16, type=int, required=False,
-        help='The filter used to match logs.')
+        help='Batch size.')
+    TRAIN_PARSER.add_argument(
+        '-profile_batch', default=False, type=bool, required=False,
+        help='If True, use the batch size of the loader profile instead of -batch_size.')
     TRAIN_PARSER.add_argument(
         '-train_path', default=None, type=str, required=False,
         help='Folder containing training images, with images and masks subdirectory.')
@@ -373,14 +514,120 @@ if __name__=='__main__':
     TRAIN_PARSER.add_argument(
         '-tier2', default=None, type=bool, required=False,
         help='whether or not to train on tier 2 data')
+    TRAIN_PARSER.add_argument(
+        '-cache_gb', default=None, type=float, required=False,
+        help='Size (GB) of the decoded tile cache shared across loader workers.')
+    TRAIN_PARSER.add_argument(
+        '-sampler', default=None, type=str, required=False, choices=['city', 'scene', 'block'],
+        help='Draw region-balanced epochs over cities or scenes, or shuffle scene blocks (block).')
+    TRAIN_PARSER.add_argument(
+        '-epoch_len', default=None, type=int, required=False,
+        help='Number of tiles per epoch when using a region-balanced sampler.')
+    TRAIN_PARSER.add_argument(
+        '-density_target', default=None, type=float, required=False,
+        help='Target building fraction for training crops (uses mask density tables).')
+    TRAIN_PARSER.add_argument(
+        '-channel_stats', default=None, type=str, required=False,
+        help='Channel stats file: normalize input per city and in the model.')
+    TRAIN_PARSER.add_argument(
+        '-lovasz_bins', default=None, type=int, required=False,
+        help='Approximate the Lovasz hinge with this many error bins instead of sorting.')
+    TRAIN_PARSER.add_argument(
+        '-head_loss', default=None, type=float, required=False, metavar='BOUNDARY_WEIGHT',
+        help='Compute the Lovasz loss at head resolution (stride 8), adding a full-resolution \
+                boundary BCE term with this weight (0 for none).')
+    TRAIN_PARSER.add_argument(
+        '-amp', default=None, type=str, required=False, choices=['bf16', 'fp16'],
+        help='Autocast precision for forward passes (bf16 on CPU; fp16 or bf16 on GPU).')
+    TRAIN_PARSER.add_argument(
+        '-checkpoint', default=None, type=str, nargs='+', required=False, choices=Network.CHECKPOINT_SEGMENTS,
+        help='Recompute the activations of these backbone layers / the JPU during backward.')
+    TRAIN_PARSER.add_argument(
+        '-checkpoint_blocks', default=False, type=bool, required=False,
+        help='If True, checkpoint each bottleneck block rather than whole layers.')
+    TRAIN_PARSER.add_argument(
+        '-head_epochs', default=0, type=int, required=False,
+        help='Epochs with the backbone frozen before layers start unfreezing.')
+    TRAIN_PARSER.add_argument(
+        '-feature_cache', default=False, type=bool, required=False,
+        help='If True, train the head_epochs from backbone features cached as fp16 memmaps \
+                (about 24 MB per tile, roughly 1 TB for the full training split).')
+    TRAIN_PARSER.add_argument(
+        '-procs', default=1, type=int, required=False,
+        help='Training processes per node (distributed data parallel when nodes * procs > 1).')
+    TRAIN_PARSER.add_argument(
+        '-nodes', default=1, type=int, required=False,
+        help='Number of nodes taking part in distributed training.')
+    TRAIN_PARSER.add_argument(
+        '-node_rank', default=0, type=int, required=False,
+        help='Index of this node among the nodes.')
+    TRAIN_PARSER.add_argument(
+        '-init_file', default=INIT_FILE, type=str, required=False,
+        help='Rendezvous file for distributed training, on a filesystem shared by all nodes.')
+    TRAIN_PARSER.add_argument(
+        '-dist_backend', default='gloo', type=str, required=False, choices=['gloo', 'nccl'],
+        help='torch.distributed backend (gloo works on CPU and GPU, nccl on GPU only).')
+
+    TUNE_PARSER = SUBPARSERS.add_parser('autotune', help=autotune_loader.__doc__)
+    TUNE_PARSER.add_argument(
+        '-train_path', default='training_data', type=str, required=False,
+        help='Folder containing training images, with images and masks subdirectory.')
+    TUNE_PARSER.add_argument(
+        '-max_batches', default=20, type=int, required=False,
+        help='Batches timed per pass for each configuration.')
+    TUNE_PARSER.add_argument(
+        '-out', default=PROFILE_FILE, type=str, required=False,
+        help='Where to write the best loader profile.')
+
+    STATS_PARSER = SUBPARSERS.add_parser('stats', help=compute_channel_stats.__doc__)
+    STATS_PARSER.add_argument(
+        '-train_path', default='training_data', type=str, required=False,
+        help='Folder containing training images, with images and masks subdirectory.')
+    STATS_PARSER.add_argument(
+        '-tiles_per_city', default=200, type=int, required=False,
+        help='Tiles sampled per city (0 for all).')
+    STATS_PARSER.add_argument(
+        '-workers', default=4, type=int, required=False,
+        help='Decoding processes.')
+    STATS_PARSER.add_argument(
+        '-out', default=STATS_FILE, type=str, required=False,
+        help='Where to write the stats file.')
 
     PARSED_ARGS = PARSER.parse_args()
     print('Args:\n', PARSED_ARGS)
 
+    if PARSED_ARGS.command == 'autotune':
+        autotune_loader(
+            MyDataset(in_dir=PARSED_ARGS.train_path, custom_transforms=train_transform, split='train'),
+            max_batches=PARSED_ARGS.max_batches, out_path=PARSED_ARGS.out
+            )
+
+    if PARSED_ARGS.command == 'stats':
+        TILES = select_tiles(PARSED_ARGS.train_path)
+        compute_channel_stats(
+            TILES['image'].values, tile_cities(TILES['scene']), nodata=TILES['nodata'].values,
+            tiles_per_group=PARSED_ARGS.tiles_per_city, num_workers=PARSED_ARGS.workers,
+            out_path=PARSED_ARGS.out
+            )
+
     if PARSED_ARGS.command == 'all':
-        train_fastfcn_mod(
+        if PARSED_ARGS.profile_batch:
+            PARSED_ARGS.batch_size = load_loader_profile().get('batch_size', PARSED_ARGS.batch_size)
+        TRAIN_KWARGS = dict(
             num_epochs=PARSED_ARGS.epochs, reporting_int=PARSED_ARGS.report,
             batch_size=PARSED_ARGS.batch_size, experiment_name=PARSED_ARGS.name,
             train_path=PARSED_ARGS.train_path, batch_trim=PARSED_ARGS.batch_trim, 
-            tier2= PARSED_ARGS.tier2
+            tier2= PARSED_ARGS.tier2, cache_gb=PARSED_ARGS.cache_gb,
+            sampler=PARSED_ARGS.sampler, epoch_len=PARSED_ARGS.epoch_len,
+            density_target=PARSED_ARGS.density_target, channel_stats=PARSED_ARGS.channel_stats,
+            lovasz_bins=PARSED_ARGS.lovasz_bins, boundary_weight=PARSED_ARGS.head_loss,
+            amp=PARSED_ARGS.amp, checkpoint=PARSED_ARGS.checkpoint,
+            checkpoint_blocks=PARSED_ARGS.checkpoint_blocks,
+            head_epochs=PARSED_ARGS.head_epochs, feature_cache=PARSED_ARGS.feature_cache
+            )
+        # batch_size is per process; the global batch is nodes * procs * batch_size.
+        launch(
+            train_fastfcn_mod, TRAIN_KWARGS, procs=PARSED_ARGS.procs, nodes=PARSED_ARGS.nodes,
+            node_rank=PARSED_ARGS.node_rank, init_file=PARSED_ARGS.init_file,
+            backend=PARSED_ARGS.dist_backend
             )